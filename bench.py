@@ -0,0 +1,459 @@
+# bench.py - offline load test for the message hot path
+# Usage: python bench.py [--rate 500] [--duration 10] [--guilds 50] [--users 2000]
+#                        [--latency 0.05] [--storage json|sqlite] [--out result.json]
+#                        [--compare previous.json] [--only on_message,xp,...]
+# Imports bot.py inside a scratch directory and drives it with fake guilds,
+# members, channels and messages. Every REST call the bot would make (delete,
+# send, timeout, ban, add_roles) goes to a fake that sleeps for --latency, and
+# outbound TCP is blocked, so nothing here touches the network or the real
+# state files. Results are printed and, with --out, written as JSON; --compare
+# prints the change against an earlier JSON result.
+import os, sys, json, time, random, shutil, socket, asyncio, argparse, resource, tempfile, collections, platform
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SCENARIOS = ("on_message", "xp", "automod", "log_action", "moderation")
+
+# share of generated messages that trip each filter; the rest are plain chatter
+# ("dupe" is one text posted by many accounts, i.e. a duplicate-message raid)
+MIX = (("link", 0.03), ("caps", 0.02), ("banned", 0.02), ("dupe", 0.01))
+BANNED_WORDS = ["badword", "slur", "scamlink", "freenitro"]
+CHATTER = ("hello there", "anyone up for a game?", "lol", "that patch broke everything",
+           "gm", "check the pinned message", "brb", "what time is the event?")
+
+# ---------------------------
+# Fakes
+# ---------------------------
+class FakeREST:
+    # stands in for Discord's HTTP API: every call just waits
+    def __init__(self, latency, jitter=0.2):
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = collections.Counter()
+
+    async def call(self, route):
+        self.calls[route] += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+class FakeUser:
+    def __init__(self, uid, rest, name=None, bot=False):
+        self.id = uid
+        self.bot = bot
+        self.name = name or f"user{uid}"
+        self.global_name = self.name
+        self.display_name = self.name
+        self.mention = f"<@{uid}>"
+        self._rest = rest
+
+    def __str__(self):
+        return self.name
+
+    async def send(self, *args, **kwargs):
+        await self._rest.call("dm")
+
+class FakeMember(FakeUser):
+    def __init__(self, uid, guild, rest):
+        super().__init__(uid, rest)
+        self.guild = guild
+        self.roles = []
+
+    async def add_roles(self, *roles, reason=None):
+        await self._rest.call("add_roles")
+
+    async def timeout(self, until, reason=None):
+        await self._rest.call("timeout")
+
+    def is_timed_out(self):
+        return False
+
+    async def ban(self, reason=None, **kwargs):
+        await self._rest.call("ban")
+
+class FakeChannel:
+    def __init__(self, cid, guild, rest):
+        self.id = cid
+        self.guild = guild
+        self.name = f"channel-{cid}"
+        self.mention = f"<#{cid}>"
+        self._rest = rest
+
+    async def send(self, *args, **kwargs):
+        await self._rest.call("channel_send")
+
+    def get_partial_message(self, mid):
+        return FakeMessage(mid, self.guild, FakeUser(0, self._rest), "")
+
+class FakeRole:
+    def __init__(self, rid):
+        self.id = rid
+        self.name = f"role-{rid}"
+
+class FakeGuild:
+    def __init__(self, gid, rest, users):
+        self.id = gid
+        self.name = f"guild-{gid}"
+        self.text = FakeChannel(gid * 10 + 1, self, rest)
+        self.log = FakeChannel(gid * 10 + 2, self, rest)
+        self.system_channel = self.text
+        self.channels = {c.id: c for c in (self.text, self.log)}
+        self.roles = {}
+        self.members = [FakeMember(gid * 1_000_000 + i, self, rest) for i in range(users)]
+        self.by_id = {m.id: m for m in self.members}
+
+    def get_member(self, uid):
+        return self.by_id.get(uid)
+
+    def get_channel(self, cid):
+        return self.channels.get(cid)
+
+    def get_role(self, rid):
+        role = self.roles.get(rid)
+        if role is None:
+            role = self.roles[rid] = FakeRole(rid)
+        return role
+
+class FakeMessage:
+    _state = None  # commands.Context copies this; never used for a non-command
+
+    def __init__(self, mid, guild, author, content):
+        self.id = mid
+        self.guild = guild
+        self.author = author
+        self.channel = guild.text
+        self.content = content
+        self.created = time.perf_counter()
+
+    async def delete(self):
+        await self.author._rest.call("message_delete")
+
+class FakeResponse:
+    def __init__(self, rest):
+        self._rest = rest
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def send_message(self, *args, **kwargs):
+        self._done = True
+        await self._rest.call("interaction_response")
+
+    async def defer(self, *args, **kwargs):
+        self._done = True
+        await self._rest.call("interaction_response")
+
+class FakeInteraction:
+    def __init__(self, guild, user, rest):
+        self.guild = guild
+        self.user = user
+        self.response = FakeResponse(rest)
+        self.extras = {}
+        self.command = None
+
+def block_network():
+    # the harness must never reach Discord; fail loudly if anything tries
+    real_connect = socket.socket.connect
+
+    def connect(self, address):
+        if self.family in (socket.AF_INET, socket.AF_INET6):
+            raise OSError("bench.py: network access is disabled")
+        return real_connect(self, address)
+
+    socket.socket.connect = connect
+
+# ---------------------------
+# Measurement helpers
+# ---------------------------
+def percentile(samples, p):
+    if not samples:
+        return None
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(round(p / 100 * (len(s) - 1))))]
+
+def bytes_written():
+    # wchar counts every byte handed to write(), including writes from the
+    # storage executor threads, and works on tmpfs where write_bytes stays 0
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak  # bytes on macOS
+
+def summarize(name, latencies, seconds, extra=None):
+    ops = len(latencies)
+    result = {
+        "ops": ops,
+        "seconds": round(seconds, 4),
+        "throughput": round(ops / seconds, 1) if seconds else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 4) if ops else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 4) if ops else None,
+        "max_ms": round(max(latencies) * 1000, 4) if ops else None,
+    }
+    result.update(extra or {})
+    print(f"[bench] {name:<12} {ops:>8} ops  {result['throughput'] or 0:>10.1f}/s  "
+          f"p50={result['p50_ms'] or 0:.3f}ms  p99={result['p99_ms'] or 0:.3f}ms")
+    return result
+
+class Scenario:
+    def __init__(self, bot, args, rest):
+        self.bot = bot
+        self.args = args
+        self.rest = rest
+        self.rng = random.Random(args.seed)
+        self.guilds = [FakeGuild(1000 + i, rest, args.users) for i in range(args.guilds)]
+        self.next_id = 1
+
+    def configure_guilds(self):
+        for g in self.guilds:
+            gcfg = self.bot.guild_config(g.id)
+            gcfg.log_channel = g.log.id
+            gcfg.banned_words = list(BANNED_WORDS)
+            gcfg.dup_filter = True  # opt-in, as /setdupes would
+            gcfg.level_rewards = {5: 5000 + g.id, 10: 6000 + g.id}
+            self.bot.save_config(g.id)
+
+    def message(self):
+        g = self.rng.choice(self.guilds)
+        author = self.rng.choice(g.members)
+        # chatter varies per message so ordinary talk doesn't look like a raid
+        roll, content = self.rng.random(), f"{self.rng.choice(CHATTER)} {self.rng.randrange(10000)}"
+        for kind, share in MIX:
+            if roll < share:
+                content = {
+                    "link": "look at https://example.invalid/promo",
+                    "caps": "WHY IS NOBODY ANSWERING ME",
+                    "banned": f"get your {self.rng.choice(BANNED_WORDS)} here",
+                    "dupe": "join my server for free stuff discord.gg/raid",
+                }[kind]
+                break
+            roll -= share
+        self.next_id += 1
+        return FakeMessage(self.next_id, g, author, content)
+
+    async def on_message(self):
+        # open loop: messages arrive at --rate regardless of how fast the bot
+        # keeps up; latency is arrival -> process_guild_message finished
+        bot, args = self.bot, self.args
+        latencies = []
+        inner = bot.process_guild_message
+
+        async def measured(message, overloaded=False):
+            try:
+                return await inner(message, overloaded)
+            finally:
+                latencies.append(time.perf_counter() - message.created)
+
+        bot.process_guild_message = measured
+        total = int(args.rate * args.duration)
+        tick = 0.01
+        per_tick = args.rate * tick
+        sent, owed = 0, 0.0
+        start = time.perf_counter()
+        try:
+            while sent < total:
+                owed += per_tick
+                while owed >= 1 and sent < total:
+                    await bot.on_message(self.message())
+                    sent += 1
+                    owed -= 1
+                next_at = start + (sent / args.rate)
+                await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+            # let the queues drain, but don't wait forever on a bot that can't keep up
+            deadline = time.perf_counter() + max(5.0, args.duration)
+            while len(latencies) < total - self.dropped() and time.perf_counter() < deadline:
+                await asyncio.sleep(0.01)
+        finally:
+            bot.process_guild_message = inner
+        seconds = time.perf_counter() - start
+        workers = bot.event_router.stats()
+        return summarize("on_message", latencies, seconds, {
+            "offered": total,
+            "offered_rate": args.rate,
+            "dropped": sum(w["dropped"] for w in workers),
+            "shed": sum(w["shed"] for w in workers),
+            "max_queue_lag_ms": round(max(w["max_lag_seconds"] for w in workers) * 1000, 3),
+        })
+
+    def dropped(self):
+        return sum(w["dropped"] for w in self.bot.event_router.stats())
+
+    def _loop(self, name, fn, n):
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(n):
+            t0 = time.perf_counter()
+            fn()
+            latencies.append(time.perf_counter() - t0)
+        return summarize(name, latencies, time.perf_counter() - start)
+
+    async def xp(self):
+        members = [self.rng.choice(self.rng.choice(self.guilds).members) for _ in range(self.args.iterations)]
+        it = iter(members)
+        return self._loop("xp", lambda: self.bot.xp_add_message(next(it)), len(members))
+
+    async def automod(self):
+        messages = [self.message() for _ in range(self.args.iterations)]
+        it = iter(messages)
+        bot = self.bot
+
+        def check():
+            m = next(it)
+            bot.automod_pipeline(m.guild.id, bot.guild_config(m.guild.id)).match(m, m.content)
+
+        return self._loop("automod", check, len(messages))
+
+    async def log_action(self):
+        n = self.args.iterations
+        guilds = [self.rng.choice(self.guilds) for _ in range(n)]
+        it = iter(guilds)
+        result = self._loop("log_action", lambda: self.bot.log_action(next(it), "bench log line"), n)
+        result.update(self.bot.log_dispatcher.stats())
+        return result
+
+    async def moderation(self):
+        # warn/timeout commands, `--concurrency` at a time, each paying REST latency
+        bot, args = self.bot, self.args
+        latencies = []
+        sem = asyncio.Semaphore(args.concurrency)
+        mod = FakeUser(1, self.rest, name="moderator")
+
+        async def one(i):
+            g = self.rng.choice(self.guilds)
+            member = self.rng.choice(g.members)
+            inter = FakeInteraction(g, mod, self.rest)
+            async with sem:
+                t0 = time.perf_counter()
+                if i % 2:
+                    await bot.slash_warn.callback(inter, member, "bench")
+                else:
+                    await bot.slash_timeout.callback(inter, member, "10m", "bench")
+                latencies.append(time.perf_counter() - t0)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(args.commands)))
+        return summarize("moderation", latencies, time.perf_counter() - start,
+                         {"concurrency": args.concurrency})
+
+async def run(bot, args):
+    await bot.load_state()
+    rest = FakeREST(args.latency)
+    # bot.user is only read by process_commands to ignore its own messages
+    bot.bot._connection.user = FakeUser(1, rest, name="bench-bot", bot=True)
+    sc = Scenario(bot, args, rest)
+    sc.configure_guilds()
+    bot.xp_store.start()
+    bot.event_router.start()
+
+    wanted = args.only.split(",") if args.only else SCENARIOS
+    results = {}
+    for name in SCENARIOS:
+        if name in wanted:
+            results[name] = await getattr(sc, name)()
+
+    t0 = time.perf_counter()
+    await bot.xp_store.close()
+    bot.config_store.flush()
+    await bot.storage.flush()
+    results["final_flush_seconds"] = round(time.perf_counter() - t0, 4)
+    results["rest_calls"] = dict(rest.calls)
+    results["state_load_seconds"] = round(bot.startup_timings["state"], 4)
+    return results
+
+def compare(current, previous):
+    print("[bench] change vs previous run:")
+    for name, cur in current["scenarios"].items():
+        old = previous.get("scenarios", {}).get(name)
+        if not isinstance(cur, dict) or not isinstance(old, dict):
+            continue
+        parts = []
+        for key in ("throughput", "p50_ms", "p99_ms"):
+            a, b = old.get(key), cur.get(key)
+            if a and b is not None:
+                parts.append(f"{key} {a} -> {b} ({(b - a) / a * 100:+.1f}%)")
+        print(f"[bench]   {name:<12} " + ", ".join(parts))
+    for key in ("disk_bytes_written", "peak_rss_kb"):
+        a, b = previous.get(key), current.get(key)
+        if a and b is not None:
+            print(f"[bench]   {key:<18} {a} -> {b} ({(b - a) / a * 100:+.1f}%)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the message hot path")
+    parser.add_argument("--rate", type=float, default=500, help="messages per second offered to on_message")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of on_message load")
+    parser.add_argument("--guilds", type=int, default=50)
+    parser.add_argument("--users", type=int, default=200, help="members per guild")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake REST latency in seconds")
+    parser.add_argument("--iterations", type=int, default=50000, help="calls for the xp/automod/log_action loops")
+    parser.add_argument("--commands", type=int, default=500, help="moderation commands to run")
+    parser.add_argument("--concurrency", type=int, default=20, help="moderation commands in flight")
+    parser.add_argument("--storage", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--only", default=None, help="comma separated subset of " + ",".join(SCENARIOS))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default=None, help="write results as JSON here")
+    parser.add_argument("--compare", default=None, help="earlier JSON result to diff against")
+    parser.add_argument("--keep-state", action="store_true", help="keep the scratch state directory")
+    args = parser.parse_args()
+    out = os.path.abspath(args.out) if args.out else None
+    previous = os.path.abspath(args.compare) if args.compare else None
+
+    block_network()
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.chdir(workdir)
+    os.environ.update(TOKEN="bench", STORAGE_BACKEND=args.storage, DB_FILE=os.path.join(workdir, "bot.db"))
+    os.environ.pop("METRICS_PORT", None)
+    sys.path.insert(0, HERE)
+
+    rss_before = peak_rss_kb()
+    t0 = time.perf_counter()
+    import bot
+    import_seconds = time.perf_counter() - t0
+    written_before = bytes_written()
+
+    results = asyncio.run(run(bot, args))
+    bot.storage.close()
+
+    written_after = bytes_written()
+    report = {
+        "meta": {
+            "args": {k: v for k, v in vars(args).items() if k not in ("out", "compare", "keep_state")},
+            "python": platform.python_version(),
+            "discord_py": bot.discord.__version__,
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "import_seconds": round(import_seconds, 4),
+        "state_load_seconds": results["state_load_seconds"],
+        "scenarios": {k: v for k, v in results.items() if isinstance(v, dict) and "ops" in v},
+        "final_flush_seconds": results["final_flush_seconds"],
+        "rest_calls": results["rest_calls"],
+        "disk_bytes_written": written_after - written_before if written_before is not None else None,
+        "state_bytes_on_disk": sum(os.path.getsize(os.path.join(workdir, f)) for f in os.listdir(workdir)
+                                   if os.path.isfile(os.path.join(workdir, f))),
+        "peak_rss_kb": peak_rss_kb(),
+        "rss_before_import_kb": rss_before,
+    }
+    print(f"[bench] disk written={report['disk_bytes_written']} bytes  peak rss={report['peak_rss_kb']} KB")
+    os.chdir(HERE)
+    if args.keep_state:
+        print(f"[bench] state kept in {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if out:
+        with open(out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"[bench] results written to {out}")
+    if previous:
+        with open(previous, encoding="utf-8") as f:
+            compare(report, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,25 @@
 # bot.py - All-in-one moderation + XP + tickets + reaction-roles + premium + rotating status
-# Requires: discord.py 2.x, python-dotenv, aiohttp
+# Requires: discord.py 2.x, python-dotenv, aiohttp, sortedcontainers
+import time
+BOOT_STARTED = time.perf_counter()  # startup timings are measured from here
 import discord
 from discord.ext import commands, tasks
 from discord import app_commands
 from discord.ui import View, Button
+from aiohttp import web
 from dotenv import load_dotenv
-import os, json, re, time, datetime, random, asyncio, aiohttp, traceback
+from sortedcontainers import SortedList
+import os, io, json, re, struct, mmap, hashlib, unicodedata, datetime, random, asyncio, collections, bisect, heapq, functools, logging, threading, gzip, html, aiohttp, socket, traceback, signal, sys, math, sqlite3, concurrent.futures
+from array import array
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; the infractions ledger then skips file locking
+    fcntl = None
+try:
+    import zstandard  # optional: smaller ticket transcripts
+except ImportError:
+    zstandard = None
 
 # ---------------------------
 # Load token
@@ -15,6 +29,146 @@ TOKEN = os.getenv("TOKEN")
 if not TOKEN:
     raise RuntimeError("No TOKEN in .env. Add TOKEN=your_bot_token")
 
+# ---------------------------
+# Sharding / clustering
+# ---------------------------
+# AUTO_SHARD=1 runs a single AutoShardedBot. SHARD_COUNT + SHARD_IDS make the
+# process own only those shards; launcher.py starts one process per shard
+# range with CLUSTER_ID/CLUSTER_IPC set so they can report stats back.
+def parse_shard_ids(text):
+    ids = []
+    for part in text.replace(" ", "").split(","):
+        if not part:
+            continue
+        if "-" in part:
+            lo, hi = part.split("-", 1)
+            ids.extend(range(int(lo), int(hi) + 1))
+        else:
+            ids.append(int(part))
+    return ids or None
+
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None
+SHARD_IDS = parse_shard_ids(os.getenv("SHARD_IDS", ""))
+AUTO_SHARD = os.getenv("AUTO_SHARD") == "1" or SHARD_COUNT is not None
+CLUSTER_ID = os.getenv("CLUSTER_ID")
+CLUSTER_IPC = os.getenv("CLUSTER_IPC")
+CLUSTER_REPORT_INTERVAL = 15
+
+# ---------------------------
+# Metrics
+# ---------------------------
+# Opt-in: set METRICS_PORT to serve Prometheus text format on
+# http://METRICS_HOST:METRICS_PORT/metrics (cluster N of launcher.py listens on
+# METRICS_PORT + N). With it unset every observe/inc call returns straight away.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _labels(pairs, extra=None):
+    items = list(pairs) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in items) + "}"
+
+class Metrics:
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self.counters = {}    # (name, labels) -> value
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(labels.items()))
+        h = self.histograms.get(key)
+        if h is None:
+            h = self.histograms[key] = [0] * (len(METRIC_BUCKETS) + 2)
+        i = bisect.bisect_left(METRIC_BUCKETS, value)
+        if i < len(METRIC_BUCKETS):  # above the last bound only +Inf (the count) sees it
+            h[i] += 1
+        h[-2] += value
+        h[-1] += 1
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(labels.items()))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def render(self, gauges=()):
+        out, typed = [], set()
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in self.help:
+                    out.append(f"# HELP {name} {self.help[name]}")
+                out.append(f"# TYPE {name} {kind}")
+        for (name, labels), h in sorted(self.histograms.items()):
+            header(name, "histogram")
+            running = 0
+            for bound, n in zip(METRIC_BUCKETS, h):
+                running += n
+                out.append(f"{name}_bucket{_labels(labels, ('le', bound))} {running}")
+            out.append(f"{name}_bucket{_labels(labels, ('le', '+Inf'))} {h[-1]}")
+            out.append(f"{name}_sum{_labels(labels)} {h[-2]}")
+            out.append(f"{name}_count{_labels(labels)} {h[-1]}")
+        for (name, labels), value in sorted(self.counters.items()):
+            header(name, "counter")
+            out.append(f"{name}{_labels(labels)} {value}")
+        for name, labels, value in gauges:
+            header(name, "gauge")
+            out.append(f"{name}{_labels(labels.items())} {value}")
+        return "\n".join(out) + "\n"
+
+metrics = Metrics(enabled=bool(METRICS_PORT))
+metrics.describe("bot_event_seconds", "Time spent in gateway event handlers")
+metrics.describe("bot_function_seconds", "Time spent in hot-path helpers")
+metrics.describe("bot_command_seconds", "Slash command handler latency")
+metrics.describe("bot_storage_flush_seconds", "Storage flush/commit duration")
+metrics.describe("bot_automod_actions_total", "Messages removed by automod, by rule")
+metrics.describe("bot_rest_requests_total", "REST requests made, by method")
+metrics.describe("bot_rest_ratelimited_total", "429 responses from the REST API that discord.py waited out and retried")
+metrics.describe("bot_rest_ratelimit_failures_total", "REST requests that still failed with 429 after discord.py's retries")
+metrics.describe("bot_config_reloads_total", "Hand edits of config.json picked up or rejected")
+
+# set while /debug profile runs; timed handlers report into it as well
+active_profile = None
+
+def record_timing(metric, name, seconds):
+    metrics.observe(metric, seconds, event=name)
+    if active_profile is not None:
+        active_profile.record_handler(name, seconds)
+
+def timed(metric, name):
+    # decorator recording a function's wall time into `metric{event=name}`
+    def deco(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                if not metrics.enabled and active_profile is None:
+                    return await fn(*args, **kwargs)
+                t0 = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    record_timing(metric, name, time.perf_counter() - t0)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not metrics.enabled and active_profile is None:
+                    return fn(*args, **kwargs)
+                t0 = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    record_timing(metric, name, time.perf_counter() - t0)
+        return wrapper
+    return deco
+
 # ---------------------------
 # File helpers & defaults
 # ---------------------------
@@ -29,23 +183,454 @@ def save_json(fname, data):
     with open(fname, "w", encoding="utf-8") as f:
         json.dump(data, f, indent=4)
 
+def save_json_atomic(fname, data):
+    # write to a temp file next to the target and rename over it, so a crash
+    # mid-write never leaves a truncated file behind; `data` may also be the
+    # already-encoded text
+    tmp = f"{fname}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(data if isinstance(data, str) else json.dumps(data, indent=4))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, fname)
+
 # Files
 CONFIG_FILE = "config.json"
 WARN_FILE = "warnings.json"
 TIMEOUTS_FILE = "timeouts.json"
-XP_FILE = "xp.json"
+XP_FILE = "xp.json"           # import/export only; the JSON backend keeps XP in XP_SNAPSHOT_FILE
+XP_SNAPSHOT_FILE = "xp.bin"
+XP_LOG_FILE = "xp.bin.log"    # changes since the snapshot, folded into it now and then
 REACTION_FILE = "reaction_roles.json"
+SCHEDULED_FILE = "scheduled.json"
 TICKETS_DIR = "tickets"
 
-# Ensure files exist with safe default structures
-config = ensure_json(CONFIG_FILE, {"guilds": {}})
-warnings_data = ensure_json(WARN_FILE, {})
-timeouts_data = ensure_json(TIMEOUTS_FILE, {})
-xp_data = ensure_json(XP_FILE, {})
-reaction_panels = ensure_json(REACTION_FILE, {})
+# ---------------------------
+# Storage backends
+# ---------------------------
+# STORAGE_BACKEND=json (default) keeps the one-file-per-kind JSON layout;
+# STORAGE_BACKEND=sqlite stores the same data in row-per-key tables.
+# Either way the bot works on in-memory dicts returned by storage.load(kind)
+# and calls storage.mark(kind, key) after changing a key; marked keys are
+# committed together shortly after, off the event loop. XP is the exception:
+# XPStore keeps its own columnar layout and persists itself (see XPStore).
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+DB_FILE = os.getenv("DB_FILE", "bot.db")
+STORAGE_FLUSH_DELAY = 0.5  # seconds marked keys may wait before being committed
 
-if not os.path.isdir(TICKETS_DIR):
-    os.makedirs(TICKETS_DIR, exist_ok=True)
+STORAGE_FILES = {
+    "config": CONFIG_FILE,
+    "warnings": WARN_FILE,
+    "timeouts": TIMEOUTS_FILE,
+    "reaction_panels": REACTION_FILE,
+    "scheduled": SCHEDULED_FILE,
+}
+
+class BaseStorage:
+    def __init__(self):
+        self.docs = {}
+        self._dirty = {}
+        self._flush_task = None
+        self._flush_lock = None
+
+    def load(self, kind):
+        doc = self._load(kind)
+        if kind == "config":
+            doc.setdefault("guilds", {})
+        self.docs[kind] = doc
+        return doc
+
+    def container(self, kind):
+        # the mapping the keys of a kind live in
+        doc = self.docs[kind]
+        return doc["guilds"] if kind == "config" else doc
+
+    def mark(self, kind, *keys):
+        self._dirty.setdefault(kind, set()).update(str(k) for k in keys)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # no loop yet; picked up by the next flush
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(STORAGE_FLUSH_DELAY)
+        await self.flush()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        # one commit at a time: two overlapping writes of a kind would race
+        # on its temp file
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            t0 = time.perf_counter()
+            try:
+                await self.commit(dirty)
+                metrics.observe("bot_storage_flush_seconds", time.perf_counter() - t0, store="state")
+            except asyncio.CancelledError:
+                # shutdown: close() commits them synchronously (rewriting a
+                # key the executor already wrote is harmless)
+                for kind, keys in dirty.items():
+                    self._dirty.setdefault(kind, set()).update(keys)
+                raise
+            except Exception:
+                for kind, keys in dirty.items():
+                    self._dirty.setdefault(kind, set()).update(keys)
+                print("storage flush error:", traceback.format_exc())
+
+    def flush_sync(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        self.commit_sync(dirty)
+
+    def changed_on_disk(self, kind):
+        # only file-backed kinds can be edited behind our back
+        return False
+
+    def all_guild_ids(self):
+        # every configured guild, including ones other clusters own
+        return [int(gid) for gid in self.docs["config"]["guilds"]]
+
+    def close(self):
+        self.flush_sync()
+
+def _file_sig(fname):
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+class JSONStorage(BaseStorage):
+    # Whole-document files. Every commit rewrites the touched files: encoded
+    # on the loop, written via temp file + rename in the default executor.
+    def __init__(self):
+        super().__init__()
+        self._sigs = {}        # kind -> (inode, mtime, size) as of our last read/write
+        self._writing = set()  # kinds with a write in flight
+
+    def _load(self, kind):
+        fname = STORAGE_FILES[kind]
+        default = {"guilds": {}} if kind == "config" else {}
+        if not os.path.exists(fname):
+            save_json(fname, default)
+        # stat before reading: an edit racing the read only costs a reload
+        sig = _file_sig(fname)
+        doc = ensure_json(fname, default)
+        self._sigs[kind] = sig
+        return doc
+
+    def pending(self, kind):
+        return kind in self._writing or kind in self._dirty
+
+    def changed_on_disk(self, kind):
+        # one stat() call; unflushed local changes win over a concurrent edit
+        if self.pending(kind):
+            return False
+        return _file_sig(STORAGE_FILES[kind]) != self._sigs.get(kind)
+
+    def reread(self, kind):
+        # Fresh parse of a kind edited on disk, for the executor. self.docs is
+        # left alone (the caller decides what to take over) and the file's
+        # signature is recorded even if it fails to parse, so a bad edit is
+        # reported once rather than on every poll.
+        fname = STORAGE_FILES[kind]
+        sig = _file_sig(fname)
+        try:
+            with open(fname, "r", encoding="utf-8") as f:
+                return json.load(f)
+        finally:
+            self._sigs[kind] = sig
+
+    def _snapshot(self, kinds):
+        # Encoded on the loop thread: the documents hold nested dicts the bot
+        # mutates in place (panel roles, job attempts), so the executor only
+        # ever gets finished strings.
+        snaps = {}
+        for kind in kinds:
+            doc = self.docs.get(kind)
+            if doc is None:
+                continue
+            snaps[kind] = json.dumps(doc, indent=4)
+        return snaps
+
+    def _write(self, snaps):
+        for kind, snap in snaps.items():
+            save_json_atomic(STORAGE_FILES[kind], snap)
+            self._sigs[kind] = _file_sig(STORAGE_FILES[kind])
+
+    async def commit(self, changes):
+        snaps = self._snapshot(changes)
+        self._writing.update(snaps)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, snaps)
+        finally:
+            self._writing.difference_update(snaps)
+
+    def commit_sync(self, changes):
+        self._write(self._snapshot(changes))
+
+def _split_xp_key(key):
+    gid, uid = key.split("-", 1)
+    return int(gid), int(uid)
+
+# kind -> (upsert sql, delete sql, select sql, key -> delete params,
+#          (key, value) -> upsert params, row -> (key, value))
+# warnings/timeouts are the legacy user-keyed documents (stored under guild 0);
+# they are only read once, to migrate them into the infractions ledger.
+SQLITE_KINDS = {
+    "config": (
+        "INSERT INTO config (guild_id, data) VALUES (?, ?) "
+        "ON CONFLICT(guild_id) DO UPDATE SET data = excluded.data",
+        "DELETE FROM config WHERE guild_id = ?",
+        "SELECT guild_id, data FROM config",
+        lambda k: (int(k),),
+        lambda k, v: (int(k), json.dumps(v)),
+        lambda r: (str(r[0]), json.loads(r[1])),
+    ),
+    "warnings": (
+        "INSERT INTO warnings (guild_id, user_id, data) VALUES (0, ?, ?) "
+        "ON CONFLICT(guild_id, user_id) DO UPDATE SET data = excluded.data",
+        "DELETE FROM warnings WHERE guild_id = 0 AND user_id = ?",
+        "SELECT user_id, data FROM warnings WHERE guild_id = 0",
+        lambda k: (int(k),),
+        lambda k, v: (int(k), json.dumps(v)),
+        lambda r: (str(r[0]), json.loads(r[1])),
+    ),
+    "timeouts": (
+        "INSERT INTO timeouts (guild_id, user_id, data) VALUES (0, ?, ?) "
+        "ON CONFLICT(guild_id, user_id) DO UPDATE SET data = excluded.data",
+        "DELETE FROM timeouts WHERE guild_id = 0 AND user_id = ?",
+        "SELECT user_id, data FROM timeouts WHERE guild_id = 0",
+        lambda k: (int(k),),
+        lambda k, v: (int(k), json.dumps(v)),
+        lambda r: (str(r[0]), json.loads(r[1])),
+    ),
+    "xp": (
+        "INSERT INTO xp (guild_id, user_id, xp, level) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(guild_id, user_id) DO UPDATE SET xp = excluded.xp, level = excluded.level",
+        "DELETE FROM xp WHERE guild_id = ? AND user_id = ?",
+        "SELECT guild_id, user_id, xp, level FROM xp",
+        _split_xp_key,
+        lambda k, v: (*_split_xp_key(k), int(v.get("xp", 0)), int(v.get("level", 0))),
+        lambda r: (f"{r[0]}-{r[1]}", {"xp": r[2], "level": r[3]}),
+    ),
+    "reaction_panels": (
+        "INSERT INTO reaction_panels (message_id, guild_id, data) VALUES (?, ?, ?) "
+        "ON CONFLICT(message_id) DO UPDATE SET guild_id = excluded.guild_id, data = excluded.data",
+        "DELETE FROM reaction_panels WHERE message_id = ?",
+        "SELECT message_id, data FROM reaction_panels",
+        lambda k: (int(k),),
+        lambda k, v: (int(k), int(v.get("guild") or 0), json.dumps(v)),
+        lambda r: (str(r[0]), json.loads(r[1])),
+    ),
+    "scheduled": (
+        "INSERT INTO scheduled (job_id, guild_id, due, data) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(job_id) DO UPDATE SET due = excluded.due, data = excluded.data",
+        "DELETE FROM scheduled WHERE job_id = ?",
+        "SELECT job_id, data FROM scheduled",
+        lambda k: (k,),
+        lambda k, v: (k, int(v["guild"]), v["due"], json.dumps(v)),
+        lambda r: (r[0], json.loads(r[1])),
+    ),
+}
+
+# kinds whose rows belong to one guild (the legacy warnings/timeouts are not)
+SHARDED_KINDS = ("config", "xp", "reaction_panels", "scheduled")
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS config (
+    guild_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS warnings (
+    guild_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (guild_id, user_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS timeouts (
+    guild_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (guild_id, user_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS xp (
+    guild_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    xp INTEGER NOT NULL,
+    level INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS xp_guild_rank ON xp (guild_id, xp DESC);
+CREATE TABLE IF NOT EXISTS reaction_panels (
+    message_id INTEGER PRIMARY KEY,
+    guild_id INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reaction_panels_guild ON reaction_panels (guild_id);
+CREATE TABLE IF NOT EXISTS scheduled (
+    job_id TEXT PRIMARY KEY,
+    guild_id INTEGER NOT NULL,
+    due REAL NOT NULL,
+    data TEXT NOT NULL
+);
+"""
+
+class SQLiteStorage(BaseStorage):
+    # Row-per-key tables in WAL mode. The connection lives on one dedicated
+    # executor thread and each commit is a single transaction, so a crash
+    # mid-write rolls back instead of corrupting anything. The SQL strings
+    # are constants, so sqlite3's statement cache keeps them prepared.
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.created = not os.path.exists(path)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn = None
+        self._call(self._connect)
+
+    def _call(self, fn, *args):
+        return self._executor.submit(fn, *args).result()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.executescript(SQLITE_SCHEMA)
+        self._conn = conn
+
+    def _select_sql(self, kind):
+        sql = SQLITE_KINDS[kind][2]
+        if kind in SHARDED_KINDS and SHARD_COUNT and SHARD_IDS:
+            # only load the guilds this process's shards own
+            sql += f" WHERE ((guild_id >> 22) % {int(SHARD_COUNT)}) IN ({','.join(str(int(i)) for i in SHARD_IDS)})"
+        return sql
+
+    def _select(self, kind):
+        row_to_item = SQLITE_KINDS[kind][5]
+        return dict(row_to_item(r) for r in self._conn.execute(self._select_sql(kind)))
+
+    def _scan(self, kind, fn):
+        for r in self._conn.execute(self._select_sql(kind)):
+            fn(r)
+
+    def _load(self, kind):
+        doc = self._call(self._select, kind)
+        return {"guilds": doc} if kind == "config" else doc
+
+    def all_guild_ids(self):
+        # load("config") only holds this process's shards
+        rows = self._call(lambda: self._conn.execute("SELECT guild_id FROM config").fetchall())
+        return [r[0] for r in rows]
+
+    def _rows(self, changes):
+        # build parameter tuples on the loop thread so the executor never
+        # touches live dicts
+        batches = []
+        for kind, keys in changes.items():
+            if kind not in self.docs:
+                continue
+            upsert, delete, _, key_params, item_params, _ = SQLITE_KINDS[kind]
+            cont = self.container(kind)
+            ups, dels = [], []
+            for key in keys:
+                val = cont.get(key)
+                if val is None:
+                    dels.append(key_params(key))
+                else:
+                    ups.append(item_params(key, val))
+            batches.append((upsert, ups, delete, dels))
+        return batches
+
+    def _execute(self, batches):
+        conn = self._conn
+        conn.execute("BEGIN")
+        try:
+            for upsert, ups, delete, dels in batches:
+                if ups:
+                    conn.executemany(upsert, ups)
+                if dels:
+                    conn.executemany(delete, dels)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    async def commit(self, changes):
+        batches = self._rows(changes)
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._execute, batches)
+
+    def commit_sync(self, changes):
+        self._call(self._execute, self._rows(changes))
+
+    # Raw-row access for stores that keep their own in-memory layout (XP)
+    # instead of a dict from load(): scan() streams the selected rows into fn
+    # on the sqlite thread, upsert() writes ready-made parameter tuples.
+    def scan(self, kind, fn):
+        self._call(self._scan, kind, fn)
+
+    async def upsert(self, kind, rows):
+        batches = [(SQLITE_KINDS[kind][0], rows, None, ())]
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._execute, batches)
+
+    def upsert_sync(self, kind, rows):
+        self._call(self._execute, [(SQLITE_KINDS[kind][0], rows, None, ())])
+
+    def close(self):
+        super().close()
+        if self._conn is not None:
+            self._call(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+def import_json_into(store):
+    # one-shot import of the legacy JSON files into a (fresh) backend
+    for kind, fname in STORAGE_FILES.items():
+        if not os.path.exists(fname):
+            continue
+        with open(fname, "r", encoding="utf-8") as f:
+            doc = json.load(f)
+        if kind == "config":
+            doc.setdefault("guilds", {})
+        store.docs[kind] = doc
+        keys = list(store.container(kind))
+        if keys:
+            store.commit_sync({kind: keys})
+        print(f"Imported {len(keys)} {kind} entries from {fname}")
+    # XP lives in the binary snapshot with the JSON backend; xp.json is only
+    # current right after --export-xp, so it is the fallback
+    for fname, read in ((XP_SNAPSHOT_FILE, read_xp_state), (XP_FILE, read_xp_json)):
+        if os.path.exists(fname):
+            rows = xp_rows(read(fname))
+            store.upsert_sync("xp", rows)
+            print(f"Imported {len(rows)} xp entries from {fname}")
+            break
+
+def make_storage():
+    if CLUSTER_ID is not None and STORAGE_BACKEND != "sqlite":
+        # several processes rewriting whole JSON files would clobber each other
+        raise RuntimeError("Cluster mode needs STORAGE_BACKEND=sqlite")
+    if STORAGE_BACKEND == "sqlite":
+        store = SQLiteStorage(DB_FILE)
+        if store.created:
+            import_json_into(store)
+        return store
+    return JSONStorage()
+
+# Nothing is read at import time: the bot fills these in load_state(), which
+# runs in the executor while the client logs in (see ServerManagerBot.login).
+storage = None
+config = None
+reaction_panels = None
 
 # ---------------------------
 # Bot & intents
@@ -53,83 +638,1022 @@ if not os.path.isdir(TICKETS_DIR):
 intents = discord.Intents.default()
 intents.members = True
 intents.message_content = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+BotBase = commands.AutoShardedBot if AUTO_SHARD else commands.Bot
+
+class MetricsTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction):
+        interaction.extras["started"] = time.perf_counter()
+        return True
+
+    async def on_error(self, interaction: discord.Interaction, error):
+        metrics.inc("bot_command_errors_total", command=interaction.command.qualified_name if interaction.command else "unknown")
+        await super().on_error(interaction, error)
+
+class ServerManagerBot(BotBase):
+    # Startup work lives here and runs exactly once per process; on_ready
+    # fires again after every gateway reconnect and only logs.
+    async def login(self, token):
+        startup_timings["import"] = startup_mark()
+        self.state_task = asyncio.create_task(load_state())
+        await super().login(token)
+
+    async def setup_hook(self):
+        startup_timings["login"] = startup_mark()
+        await self.state_task
+        register_reaction_views()
+        await sync_command_tree()
+        start_background_tasks()
+        if METRICS_PORT:
+            instrument_http()
+            await start_metrics_server()
+        startup_timings["setup"] = startup_mark()
+
+bot_options = {}
+if AUTO_SHARD and SHARD_COUNT:
+    bot_options["shard_count"] = SHARD_COUNT
+    if SHARD_IDS:
+        bot_options["shard_ids"] = SHARD_IDS
+bot = ServerManagerBot(command_prefix="!", intents=intents, tree_cls=MetricsTree, **bot_options)
+
+# ---------------------------
+# Guild config
+# ---------------------------
+# guild_config() returns a GuildConfig: one guild's entry in config.json parsed
+# into slotted attributes (ids as ints, filter flags flattened). Reading never
+# writes; save_config() marks it dirty and dirty configs are copied back into
+# config.json's dict and committed together a moment later.
+CONFIG_FLUSH_DELAY = 2.0
+DEFAULT_WELCOME_DM = "👋 Welcome {user} to {server}!"
+ID_FIELDS = ("welcome_channel", "goodbye_channel", "log_channel", "auto_role", "ticket_category", "staff_role")
+FILTER_FIELDS = ("anti_link", "anti_spam", "caps_filter", "banned_words", "spam_messages", "spam_window",
+                 "dup_filter", "dup_authors", "dup_window")
+PLAIN_FIELDS = ("welcome_dm", "premium", "transcript_format", "raid_lockdown",
+                "join_window", "join_burst_threshold", "join_raid_threshold")
+
+def _opt_int(value):
+    try:
+        return int(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+class GuildConfig:
+    # Numeric thresholds left unset stay None and the code using them falls
+    # back to its module default, so defaults are never written out.
+    __slots__ = ("guild_id",) + ID_FIELDS + FILTER_FIELDS + PLAIN_FIELDS + ("level_rewards", "extra", "extra_filters", "dirty")
+
+    def __init__(self, guild_id, raw=None):
+        raw = raw or {}
+        filters = raw.get("filters") or {}
+        self.guild_id = int(guild_id)
+        for name in ID_FIELDS:
+            setattr(self, name, _opt_int(raw.get(name)))
+        self.anti_link = bool(filters.get("anti_link", True))
+        self.anti_spam = bool(filters.get("anti_spam", True))
+        self.caps_filter = bool(filters.get("caps_filter", True))
+        self.banned_words = list(filters.get("banned_words") or [])
+        self.spam_messages = _opt_int(filters.get("spam_messages"))
+        self.spam_window = _opt_int(filters.get("spam_window"))
+        self.dup_filter = bool(filters.get("dup_filter", False))  # opt-in via /setdupes
+        self.dup_authors = _opt_int(filters.get("dup_authors"))
+        self.dup_window = _opt_int(filters.get("dup_window"))
+        self.welcome_dm = raw.get("welcome_dm") or DEFAULT_WELCOME_DM
+        self.premium = bool(raw.get("premium", False))
+        self.transcript_format = raw.get("transcript_format") or "txt"
+        self.raid_lockdown = bool(raw.get("raid_lockdown", False))
+        self.join_window = _opt_int(raw.get("join_window"))
+        self.join_burst_threshold = _opt_int(raw.get("join_burst_threshold"))
+        self.join_raid_threshold = _opt_int(raw.get("join_raid_threshold"))
+        # level: role_id
+        self.level_rewards = {int(lvl): int(rid) for lvl, rid in (raw.get("level_rewards") or {}).items() if rid}
+        # keys this version doesn't know about are kept as-is
+        self.extra = {k: v for k, v in raw.items() if k not in self.__slots__ and k not in ("filters", "level_rewards")}
+        self.extra_filters = {k: v for k, v in filters.items() if k not in FILTER_FIELDS}
+        self.dirty = False
+
+    def to_dict(self):
+        d = dict(self.extra)
+        for name in ID_FIELDS:
+            value = getattr(self, name)
+            d[name] = str(value) if value else None
+        d["welcome_dm"] = self.welcome_dm
+        d["premium"] = self.premium
+        d["level_rewards"] = {str(lvl): str(rid) for lvl, rid in self.level_rewards.items()}
+        filters = dict(self.extra_filters)
+        filters.update(anti_link=self.anti_link, anti_spam=self.anti_spam, caps_filter=self.caps_filter, dup_filter=self.dup_filter)
+        if self.banned_words:
+            filters["banned_words"] = list(self.banned_words)
+        for name in ("spam_messages", "spam_window", "dup_authors", "dup_window"):
+            if getattr(self, name) is not None:
+                filters[name] = getattr(self, name)
+        d["filters"] = filters
+        d["transcript_format"] = self.transcript_format
+        d["raid_lockdown"] = self.raid_lockdown
+        for name in ("join_window", "join_burst_threshold", "join_raid_threshold"):
+            if getattr(self, name) is not None:
+                d[name] = getattr(self, name)
+        return d
+
+class ConfigStore:
+    def __init__(self):
+        self.cache = {}
+        self.dirty = set()
+        self._flush_handle = None
+
+    def get(self, guild_id):
+        cfg = self.cache.get(guild_id)
+        if cfg is None:
+            gid = int(guild_id)
+            cfg = self.cache.get(gid)
+            if cfg is None:
+                cfg = self.cache[gid] = GuildConfig(gid, config["guilds"].get(str(gid)))
+        return cfg
+
+    def mark_dirty(self, guild_id):
+        cfg = self.get(int(guild_id))
+        cfg.dirty = True
+        self.dirty.add(cfg.guild_id)
+        # anything compiled from this guild's config is stale now
+        automod_cache.pop(cfg.guild_id, None)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # flushed on shutdown
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(CONFIG_FLUSH_DELAY, self.flush)
+
+    def flush(self):
+        self._flush_handle = None
+        if not self.dirty:
+            return
+        gids, self.dirty = self.dirty, set()
+        for gid in gids:
+            cfg = self.cache[gid]
+            config["guilds"][str(gid)] = cfg.to_dict()
+            cfg.dirty = False
+        storage.mark("config", *gids)
+
+    def apply_reload(self, guilds, parsed):
+        # Swap in the guilds whose raw entry changed on disk. Runs on the loop
+        # in one go, so handlers see either the old or the new config.
+        current = config["guilds"]
+        changed = []
+        for key in set(current) | set(guilds):
+            raw = guilds.get(key)
+            if raw == current.get(key):
+                continue
+            gid = int(key)
+            if raw is None:
+                del current[key]
+                self.cache.pop(gid, None)
+            else:
+                current[key] = raw
+                self.cache[gid] = parsed[gid]
+            automod_cache.pop(gid, None)
+            changed.append(gid)
+        return changed
+
+config_store = ConfigStore()
+
+def save_config(guild_id):
+    config_store.mark_dirty(guild_id)
+
+def guild_config(guild_id: int) -> GuildConfig:
+    return config_store.get(guild_id)
+
+# Hand edits of config.json (e.g. level_rewards, see the help text) are picked
+# up without a restart: a stat() every few seconds, and on a change the file is
+# parsed and validated in the executor and only the guilds that differ are
+# swapped in. An edit that doesn't parse leaves the running config untouched.
+CONFIG_RELOAD_INTERVAL = 5  # seconds
+
+def config_limits():
+    # (min, max) for the numeric settings; the same ranges /setspam,
+    # /setdupes and /setjoinflood accept (a function since some of the
+    # bounds are defined further down)
+    return {
+        "spam_messages": (1, 50), "spam_window": (1, SPAM_IDLE_EVICT),
+        "dup_authors": (1, 100), "dup_window": (5, 3600),
+        "join_window": (1, 600), "join_burst_threshold": (2, 1000), "join_raid_threshold": (2, 1000),
+    }
+
+def _is_id(value):
+    return (isinstance(value, str) and value.isdigit()) or (isinstance(value, int) and not isinstance(value, bool) and value > 0)
+
+def validate_guild_raw(raw):
+    # Type/range checks for one hand-edited guild entry; GuildConfig itself is
+    # lenient (it coerces or drops bad values) so it never gets to see these.
+    # -> None, or a description of the first problem.
+    if not isinstance(raw, dict):
+        return "expected an object"
+    filters = raw.get("filters")
+    if filters is None:
+        filters = {}
+    elif not isinstance(filters, dict):
+        return '"filters" must be an object'
+    for name in ID_FIELDS:
+        if raw.get(name) not in (None, "", 0) and not _is_id(raw[name]):
+            return f'"{name}" must be a channel/role id'
+    for src, names in ((filters, ("anti_link", "anti_spam", "caps_filter", "dup_filter")), (raw, ("premium", "raid_lockdown"))):
+        for name in names:
+            if src.get(name) is not None and not isinstance(src[name], bool):
+                return f'"{name}" must be true or false'
+    words = filters.get("banned_words")
+    if words is not None and not (isinstance(words, list) and all(isinstance(w, str) and w for w in words)):
+        return '"banned_words" must be a list of non-empty strings'
+    for name, (lo, hi) in config_limits().items():
+        value = (filters if name in FILTER_FIELDS else raw).get(name)
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, int) or not lo <= value <= hi:
+            return f'"{name}" must be a whole number from {lo} to {hi}'
+    if raw.get("welcome_dm") is not None and not isinstance(raw["welcome_dm"], str):
+        return '"welcome_dm" must be a string'
+    if raw.get("transcript_format") not in (None, *TRANSCRIPT_FORMATS):
+        return f'"transcript_format" must be one of {", ".join(TRANSCRIPT_FORMATS)}'
+    rewards = raw.get("level_rewards")
+    if rewards is not None:
+        if not isinstance(rewards, dict):
+            return '"level_rewards" must be an object of level -> role id'
+        for lvl, rid in rewards.items():
+            if not (lvl.isdigit() and int(lvl) > 0) or not (rid in (None, "") or _is_id(rid)):
+                return f'"level_rewards": {lvl!r} -> {rid!r} is not a level -> role id'
+    return None
+
+def parse_config_file():
+    doc = storage.reread("config")
+    guilds = doc.get("guilds") if isinstance(doc, dict) else None
+    if not isinstance(guilds, dict):
+        raise ValueError('expected an object with a "guilds" object')
+    parsed = {}
+    for key, raw in guilds.items():
+        if not key.isdigit():
+            raise ValueError(f"{key!r} is not a guild id")
+        problem = validate_guild_raw(raw)
+        if problem:
+            raise ValueError(f"guild {key}: {problem}")
+        try:
+            parsed[int(key)] = GuildConfig(key, raw)
+        except (TypeError, ValueError, AttributeError) as e:
+            raise ValueError(f"guild {key}: {e}") from None
+    return guilds, parsed
+
+@tasks.loop(seconds=CONFIG_RELOAD_INTERVAL)
+async def config_watcher():
+    if not storage.changed_on_disk("config") or config_store.dirty:
+        return
+    try:
+        guilds, parsed = await asyncio.get_running_loop().run_in_executor(None, parse_config_file)
+    except (OSError, ValueError) as e:
+        # json.JSONDecodeError is a ValueError
+        metrics.inc("bot_config_reloads_total", result="rejected")
+        print(f"config reload rejected, keeping the running config: {e}")
+        return
+    if config_store.dirty or storage.pending("config"):
+        # a save raced the edit; as with any concurrent edit, local changes win
+        print("config reload skipped: the bot saved config.json while it was being edited")
+        return
+    changed = config_store.apply_reload(guilds, parsed)
+    if changed:
+        metrics.inc("bot_config_reloads_total", result="applied")
+        print(f"🔁 Reloaded config for {len(changed)} guild(s): {', '.join(map(str, sorted(changed)))}")
 
 # ---------------------------
 # Utilities
 # ---------------------------
-def guild_config(guild_id: int):
-    gid = str(guild_id)
-    if gid not in config["guilds"]:
-        config["guilds"][gid] = {
-            "welcome_channel": None,
-            "goodbye_channel": None,
-            "log_channel": None,
-            "welcome_dm": "👋 Welcome {user} to {server}!",
-            "premium": False,
-            "level_rewards": {},  # level: role_id
-            "filters": {"anti_link": True, "anti_spam": True, "caps_filter": True},
-            "auto_role": None,
-            "ticket_category": None,
-            "staff_role": None
-        }
-        save_json(CONFIG_FILE, config)
-    return config["guilds"][gid]
 
 def now_iso():
     return datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
 
-def log_action(guild: discord.Guild, embed_or_text):
+# keep references to fire-and-forget tasks so they are not garbage collected
+background_tasks = set()
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# Log channel dispatcher: entries are queued per channel and one worker per
+# channel sends them in batches (up to 10 embeds per message, consecutive
+# text lines merged into one embed), at most one message per window.
+LOG_LOW, LOG_NORMAL, LOG_HIGH = 0, 1, 2
+LOG_BATCH_WINDOW = 1.0      # seconds to collect entries before each send
+LOG_QUEUE_MAX = 500         # per channel; beyond this low-priority entries are dropped
+LOG_EMBEDS_PER_MESSAGE = 10
+LOG_EMBED_CHARS = 6000      # Discord's total embed size limit per message
+LOG_DESCRIPTION_CHARS = 4096
+
+class LogDispatcher:
+    def __init__(self):
+        self.queues = {}   # channel id -> deque of (priority, embed or text)
+        self.workers = {}  # channel id -> task
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def submit(self, channel, item, priority=LOG_NORMAL):
+        q = self.queues.get(channel.id)
+        if q is None:
+            q = self.queues[channel.id] = collections.deque()
+        if len(q) >= LOG_QUEUE_MAX:
+            # shed the oldest entry of the lowest priority, unless the new
+            # entry is lower priority than everything queued
+            victim = min(range(len(q)), key=lambda i: q[i][0])
+            if q[victim][0] > priority:
+                self.dropped += 1
+                return False
+            del q[victim]
+            self.dropped += 1
+        q.append((priority, item))
+        task = self.workers.get(channel.id)
+        if task is None or task.done():
+            self.workers[channel.id] = asyncio.create_task(self._worker(channel))
+        return True
+
+    def _take_batch(self, q):
+        embeds, size, text = [], 0, None
+        while q:
+            item = q[0][1]
+            if isinstance(item, discord.Embed):
+                if text is not None:
+                    embeds.append(text)
+                    size += len(text)
+                    text = None
+                if len(embeds) >= LOG_EMBEDS_PER_MESSAGE or (embeds and size + len(item) > LOG_EMBED_CHARS):
+                    break
+                embeds.append(item)
+                size += len(item)
+            else:
+                line = str(item)[:LOG_DESCRIPTION_CHARS]
+                if text is None:
+                    if len(embeds) >= LOG_EMBEDS_PER_MESSAGE or (embeds and size + len(line) > LOG_EMBED_CHARS):
+                        break
+                    text = discord.Embed(description=line, color=discord.Color.blurple())
+                else:
+                    desc = text.description + "\n" + line
+                    if len(desc) > LOG_DESCRIPTION_CHARS or size + len(desc) > LOG_EMBED_CHARS:
+                        break
+                    text.description = desc
+            q.popleft()
+        if text is not None:
+            embeds.append(text)
+        return embeds
+
+    async def _worker(self, channel):
+        q = self.queues[channel.id]
+        try:
+            while q:
+                await asyncio.sleep(LOG_BATCH_WINDOW)
+                embeds = self._take_batch(q)
+                if not embeds:
+                    continue
+                try:
+                    await channel.send(embeds=embeds)
+                    self.sent += 1
+                except discord.HTTPException as e:
+                    if e.status == 429:
+                        # still rate limited after discord.py's own retries:
+                        # put the batch back and back off
+                        q.extendleft((LOG_HIGH, em) for em in reversed(embeds))
+                        await asyncio.sleep(5)
+                    else:
+                        self.failed += 1
+                except Exception:
+                    self.failed += 1
+        finally:
+            self.workers.pop(channel.id, None)
+            if not q:
+                self.queues.pop(channel.id, None)
+
+    def stats(self):
+        return {
+            "queued": sum(len(q) for q in self.queues.values()),
+            "channels": len(self.queues),
+            "sent_messages": self.sent,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+log_dispatcher = LogDispatcher()
+
+def log_action(guild: discord.Guild, embed_or_text, priority=LOG_NORMAL):
     try:
-        gcfg = guild_config(guild.id)
-        lid = gcfg.get("log_channel")
+        lid = guild_config(guild.id).log_channel
         if not lid:
             return
-        ch = guild.get_channel(int(lid))
+        ch = guild.get_channel(lid)
         if not ch:
             return
-        if isinstance(embed_or_text, discord.Embed):
-            asyncio.create_task(ch.send(embed=embed_or_text))
-        else:
-            asyncio.create_task(ch.send(embed=discord.Embed(description=str(embed_or_text), color=discord.Color.blurple())))
+        log_dispatcher.submit(ch, embed_or_text, priority)
     except Exception:
         print("log_action error:", traceback.format_exc())
 
+# DM dispatcher: handlers queue DMs instead of awaiting member.send(). A small
+# worker pool delivers them; identical notices to the same user within the
+# cooldown are sent once, and users with closed DMs are skipped for a while.
+# Welcome DMs have their own small lane, sent one at a time at a fixed pace,
+# so a join raid can neither flood Discord nor crowd out moderation notices.
+DM_QUEUE_MAX = 1000
+DM_WORKERS = 4
+WELCOME_DM_QUEUE_MAX = 200
+WELCOME_DM_INTERVAL = 1.0  # seconds between welcome DMs
+DM_DEDUPE_SECONDS = 60
+DM_CLOSED_TTL = 3600
+DM_SWEEP_INTERVAL = 60
+
+class DMDispatcher:
+    def __init__(self, workers=DM_WORKERS, maxsize=DM_QUEUE_MAX,
+                 welcome_maxsize=WELCOME_DM_QUEUE_MAX, welcome_interval=WELCOME_DM_INTERVAL):
+        self.worker_count = workers
+        self.maxsize = maxsize
+        self.welcome_maxsize = welcome_maxsize
+        self.welcome_interval = welcome_interval
+        self.queue = None
+        self.welcome_queue = None
+        self.workers = []
+        self.welcome_worker = None
+        self.recent = {}  # (user id, text) -> time the cooldown ends
+        self.closed = {}  # user id -> time to try again
+        self.next_sweep = 0.0
+        self.sent = 0
+        self.dropped = 0
+        self.welcome_dropped = 0
+        self.deduped = 0
+        self.skipped_closed = 0
+        self.failed = 0
+
+    def submit(self, user, text, welcome=False):
+        now = time.monotonic()
+        if now >= self.next_sweep:
+            self.sweep(now)
+        if self.closed.get(user.id, 0) > now:
+            self.skipped_closed += 1
+            return False
+        key = (user.id, text)
+        if self.recent.get(key, 0) > now:
+            self.deduped += 1
+            return False
+        if self.queue is None:
+            self.queue = asyncio.Queue(self.maxsize)
+            self.welcome_queue = asyncio.Queue(self.welcome_maxsize)
+        try:
+            (self.welcome_queue if welcome else self.queue).put_nowait((user, text))
+        except asyncio.QueueFull:
+            if welcome:
+                self.welcome_dropped += 1
+            else:
+                self.dropped += 1
+            return False
+        self.recent[key] = now + DM_DEDUPE_SECONDS
+        if welcome:
+            if self.welcome_worker is None or self.welcome_worker.done():
+                self.welcome_worker = asyncio.create_task(self._worker(self.welcome_queue, self.welcome_interval))
+        elif len(self.workers) < self.worker_count:
+            self.workers = [t for t in self.workers if not t.done()]
+            while len(self.workers) < self.worker_count:
+                self.workers.append(asyncio.create_task(self._worker(self.queue)))
+        return True
+
+    async def _worker(self, queue, interval=0):
+        while True:
+            user, text = await queue.get()
+            try:
+                await user.send(text)
+                self.sent += 1
+            except discord.Forbidden:
+                # DMs closed or no shared server: stop trying for a while
+                self.closed[user.id] = time.monotonic() + DM_CLOSED_TTL
+                self.failed += 1
+            except Exception:
+                self.failed += 1
+            finally:
+                queue.task_done()
+            if interval:
+                await asyncio.sleep(interval)
+
+    def sweep(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.next_sweep = now + DM_SWEEP_INTERVAL
+        self.recent = {k: t for k, t in self.recent.items() if t > now}
+        self.closed = {k: t for k, t in self.closed.items() if t > now}
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "welcome_queued": self.welcome_queue.qsize() if self.welcome_queue else 0,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "welcome_dropped": self.welcome_dropped,
+            "deduped": self.deduped,
+            "skipped_closed": self.skipped_closed,
+            "failed": self.failed,
+            "closed_users": len(self.closed),
+        }
+
+dm_dispatcher = DMDispatcher()
+
+def send_dm(user, text, welcome=False):
+    try:
+        return dm_dispatcher.submit(user, text, welcome)
+    except Exception:
+        print("send_dm error:", traceback.format_exc())
+        return False
+
 # ---------------------------
 # XP & Leveling
 # ---------------------------
+XP_FLUSH_INTERVAL = 30     # seconds between background flushes
+XP_FLUSH_MAX_PENDING = 500 # flush early once this many increments are pending
+XP_MAX = (1 << 32) - 1     # the xp column is array('I')
+XP_COMPACT_BYTES = 8 << 20 # fold the delta log into xp.bin once it is this big...
+XP_COMPACT_INTERVAL = 900  # ...or this many seconds after the last fold, if non-empty
+
+_FIB = 0x9E3779B97F4A7C15  # 2**64 / golden ratio, for Fibonacci hashing
+_M64 = (1 << 64) - 1
+
+class GuildXP:
+    # One guild's XP as parallel columns (member id 'Q', xp 'I', level 'H')
+    # plus an open-addressing hash table of row numbers in an array('i'), so
+    # a member costs ~22-30 bytes instead of a "gid-uid" string and a dict.
+    # Rows are never removed; the table is kept at most half full.
+    __slots__ = ("ids", "xp", "level", "slots", "shift")
+
+    def __init__(self, ids=None, xp=None, level=None, slots=None):
+        self.ids = ids if ids is not None else array("Q")
+        self.xp = xp if xp is not None else array("I")
+        self.level = level if level is not None else array("H")
+        if slots is None:
+            size = 8
+            while size < 2 * (len(self.ids) + 1):
+                size *= 2
+            self._reindex(size)
+        else:
+            self.slots = slots
+            self.shift = 65 - len(slots).bit_length()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _reindex(self, size):
+        self.slots = array("i", [-1]) * size
+        self.shift = 65 - size.bit_length()
+        for row, uid in enumerate(self.ids):
+            i, _ = self._probe(uid)
+            self.slots[i] = row
+
+    def _probe(self, uid):
+        # -> (slot, row); row is -1 when uid is absent and slot is where it goes
+        slots, ids = self.slots, self.ids
+        mask = len(slots) - 1
+        i = ((uid * _FIB) & _M64) >> self.shift
+        while True:
+            row = slots[i]
+            if row < 0 or ids[row] == uid:
+                return i, row
+            i = (i + 1) & mask
+
+    def row(self, uid):
+        return self._probe(uid)[1]
+
+    def set(self, uid, xp, level):
+        i, row = self._probe(uid)
+        if row >= 0:
+            self.xp[row] = xp
+            self.level[row] = level
+            return
+        self.slots[i] = len(self.ids)
+        self.ids.append(uid)
+        self.xp.append(xp)
+        self.level.append(level)
+        if 2 * len(self.ids) > len(self.slots):
+            self._reindex(2 * len(self.slots))
+
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for a in (self.ids, self.xp, self.level, self.slots))
+
+# xp.bin layout (little-endian, every column 8-byte aligned so the file can
+# be mapped and read in place):
+#   magic (8s) | guild count (Q)
+#   per guild: guild id (Q) | members (Q) | hash slots (Q)
+#   per guild, in the same order: ids Q*n | slots i*size | xp I*n | level H*n | pad to 8
+XP_SNAPSHOT_MAGIC = b"SMXPSNP1"
+
+def _le_bytes(arr):
+    if sys.byteorder == "big":
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+def xp_snapshot_chunks(guilds):
+    chunks = [struct.pack("<8sQ", XP_SNAPSHOT_MAGIC, len(guilds))]
+    chunks += [struct.pack("<QQQ", gid, len(g), len(g.slots)) for gid, g in guilds.items()]
+    for g in guilds.values():
+        chunks += [_le_bytes(g.ids), _le_bytes(g.slots), _le_bytes(g.xp), _le_bytes(g.level)]
+        pad = -(len(g.xp) * 4 + len(g.level) * 2) % 8
+        if pad:
+            chunks.append(b"\0" * pad)
+    return chunks
+
+def write_xp_snapshot(fname, chunks):
+    tmp = f"{fname}.tmp"
+    with open(tmp, "wb") as f:
+        f.writelines(chunks)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, fname)
+
+def read_xp_snapshot(fname):
+    guilds = {}
+    with open(fname, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return guilds
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                magic, count = struct.unpack_from("<8sQ", mm, 0)
+                if magic != XP_SNAPSHOT_MAGIC:
+                    raise ValueError(f"{fname} is not an XP snapshot")
+                layout = [struct.unpack_from("<QQQ", mm, 16 + 24 * i) for i in range(count)]
+                pos = 16 + 24 * count
+                for gid, n, size in layout:
+                    if size < 8 or size & (size - 1) or size < 2 * n:
+                        raise ValueError(f"{fname}: bad hash table for guild {gid}")
+                    cols = []
+                    for typecode, length in (("Q", n), ("i", size), ("I", n), ("H", n)):
+                        arr = array(typecode)
+                        end = pos + arr.itemsize * length
+                        if end > len(mm):
+                            raise ValueError(f"{fname} is truncated")
+                        arr.frombytes(view[pos:end])
+                        if sys.byteorder == "big":
+                            arr.byteswap()
+                        cols.append(arr)
+                        pos = end
+                    pos += -pos % 8
+                    ids, slots, xp, level = cols
+                    guilds[gid] = GuildXP(ids, xp, level, slots)
+            finally:
+                view.release()
+    return guilds
+
+# xp.bin.log: fixed-size (guild id, user id, xp, level) records appended by
+# every flush; a later record for a member supersedes earlier ones. Folding
+# renames it to xp.bin.log.1 and builds the next snapshot in the executor from
+# the files alone (old snapshot + that log), never from the live columns.
+_XP_LOG_RECORD = struct.Struct("<QQIH2x")
+
+def append_xp_log(fname, rows):
+    data = b"".join(_XP_LOG_RECORD.pack(*row) for row in rows)
+    with open(fname, "ab") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return len(data)
+
+def replay_xp_log(fname, guilds):
+    try:
+        with open(fname, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return
+    # a torn record at the end (crash mid-append) is ignored
+    end = len(data) - len(data) % _XP_LOG_RECORD.size
+    for gid, uid, xp, level in _XP_LOG_RECORD.iter_unpack(memoryview(data)[:end]):
+        g = guilds.get(gid)
+        if g is None:
+            g = guilds[gid] = GuildXP()
+        g.set(uid, xp, level)
+
+def read_xp_state(fname=XP_SNAPSHOT_FILE):
+    # snapshot plus whatever was logged after it (.log.1 is left over from a
+    # fold that did not finish, so it is older than .log)
+    guilds = read_xp_snapshot(fname) if os.path.exists(fname) else {}
+    replay_xp_log(XP_LOG_FILE + ".1", guilds)
+    replay_xp_log(XP_LOG_FILE, guilds)
+    return guilds
+
+def fold_xp_log():
+    # executor only; the caller holds the XP flush lock, so nothing appends
+    # to the log meanwhile
+    folding = XP_LOG_FILE + ".1"
+    if not os.path.exists(folding):
+        os.replace(XP_LOG_FILE, folding)
+    guilds = read_xp_snapshot(XP_SNAPSHOT_FILE) if os.path.exists(XP_SNAPSHOT_FILE) else {}
+    replay_xp_log(folding, guilds)
+    write_xp_snapshot(XP_SNAPSHOT_FILE, xp_snapshot_chunks(guilds))
+    os.remove(folding)
+    # -> bytes still unfolded (only if an earlier fold had failed midway)
+    return os.path.getsize(XP_LOG_FILE) if os.path.exists(XP_LOG_FILE) else 0
+
+def clear_xp_log():
+    for fname in (XP_LOG_FILE, XP_LOG_FILE + ".1"):
+        if os.path.exists(fname):
+            os.remove(fname)
+
+def read_xp_json(fname):
+    # the import/export format: {"gid-uid": {"xp": .., "level": ..}}
+    with open(fname, "r", encoding="utf-8") as f:
+        doc = json.load(f)
+    cols = {}
+    for key, entry in doc.items():
+        gid, uid = _split_xp_key(key)
+        c = cols.get(gid)
+        if c is None:
+            c = cols[gid] = (array("Q"), array("I"), array("H"))
+        c[0].append(uid)
+        c[1].append(min(int(entry.get("xp", 0)), XP_MAX))
+        c[2].append(int(entry.get("level", 0)))
+    # keys are unique, so each guild's hash table is built once at the end
+    return {gid: GuildXP(*c) for gid, c in cols.items()}
+
+def xp_rows(guilds):
+    # (guild id, user id, xp, level) tuples for the SQLite xp table
+    return [(gid, uid, xp, level) for gid, g in guilds.items() for uid, xp, level in zip(g.ids, g.xp, g.level)]
+
+class XPStore:
+    # Write-behind XP storage: increments stay in memory, changed members are
+    # marked dirty and a background task persists them on a time/size
+    # threshold, off the event loop. With SQLite the dirty rows are upserted;
+    # with the JSON backend they are appended to xp.bin.log, which is folded
+    # into the binary snapshot xp.bin every XP_COMPACT_BYTES/INTERVAL (xp.json
+    # is only an import/export format).
+    def __init__(self, flush_interval=XP_FLUSH_INTERVAL, max_pending=XP_FLUSH_MAX_PENDING):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.guilds = {}  # guild id -> GuildXP
+        self.dirty = set()  # (guild id, user id)
+        self.pending_deltas = 0
+        self.log_bytes = 0  # size of the unfolded delta log
+        self.folded_at = time.monotonic()
+        # counters
+        self.fold_count = 0
+        self.flush_count = 0
+        self.last_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+        self._wake = None
+        self._lock = None
+        self._task = None
+
+    def load(self):
+        self.guilds = {}
+        self.dirty.clear()
+        self.pending_deltas = 0
+        if isinstance(storage, SQLiteStorage):
+            storage.scan("xp", lambda r: self._table(r[0]).set(r[1], r[2], r[3]))
+        elif os.path.exists(XP_SNAPSHOT_FILE) or os.path.exists(XP_LOG_FILE):
+            self.guilds = read_xp_state()
+            self.log_bytes = sum(os.path.getsize(f) for f in (XP_LOG_FILE, XP_LOG_FILE + ".1") if os.path.exists(f))
+        elif os.path.exists(XP_FILE):
+            # first start on the snapshot format: take over xp.json once
+            self.import_json(XP_FILE)
+
+    def import_json(self, fname):
+        self.guilds = read_xp_json(fname)
+        if isinstance(storage, SQLiteStorage):
+            storage.upsert_sync("xp", xp_rows(self.guilds))
+        else:
+            write_xp_snapshot(XP_SNAPSHOT_FILE, xp_snapshot_chunks(self.guilds))
+            clear_xp_log()  # older than what was just imported
+            self.log_bytes = 0
+        print(f"Imported {sum(len(g) for g in self.guilds.values())} xp entries from {fname}")
+
+    def export_json(self, fname):
+        doc = {}
+        for gid, g in self.guilds.items():
+            for uid, xp, level in zip(g.ids, g.xp, g.level):
+                doc[f"{gid}-{uid}"] = {"xp": xp, "level": level}
+        save_json_atomic(fname, doc)
+        print(f"Exported {len(doc)} xp entries to {fname}")
+
+    def _table(self, gid):
+        g = self.guilds.get(gid)
+        if g is None:
+            g = self.guilds[gid] = GuildXP()
+        return g
+
+    def get(self, gid, uid):
+        # -> (xp, level), or None if the member has no XP in that guild
+        g = self.guilds.get(gid)
+        if g is None:
+            return None
+        row = g.row(uid)
+        if row < 0:
+            return None
+        return g.xp[row], g.level[row]
+
+    def set(self, gid, uid, xp, level):
+        self._table(gid).set(uid, xp, level)
+        self.dirty.add((gid, uid))
+        self.pending_deltas += 1
+        if self.pending_deltas >= self.max_pending and self._wake is not None:
+            self._wake.set()
+
+    def size(self, gid):
+        g = self.guilds.get(gid)
+        return len(g) if g else 0
+
+    def _changes(self, dirty):
+        # built on the loop thread, so the executor never sees live arrays;
+        # O(dirty members), whatever the size of the store
+        rows = []
+        for gid, uid in dirty:
+            g = self.guilds[gid]
+            row = g.row(uid)
+            rows.append((gid, uid, g.xp[row], g.level[row]))
+        return rows
+
+    async def _write(self, changes):
+        loop = asyncio.get_running_loop()
+        if isinstance(storage, SQLiteStorage):
+            await storage.upsert("xp", changes)
+            return
+        self.log_bytes += await loop.run_in_executor(None, append_xp_log, XP_LOG_FILE, changes)
+        if self.log_bytes >= XP_COMPACT_BYTES or time.monotonic() - self.folded_at >= XP_COMPACT_INTERVAL:
+            try:
+                left = await loop.run_in_executor(None, fold_xp_log)
+            except Exception:
+                # the rows are safe in the log; folding is retried next flush
+                print("xp log fold error:", traceback.format_exc())
+                return
+            self.log_bytes = left
+            self.folded_at = time.monotonic()
+            self.fold_count += 1
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        async with self._lock:
+            dirty, pending = self.dirty, self.pending_deltas
+            self.dirty, self.pending_deltas = set(), 0
+            t0 = time.perf_counter()
+            try:
+                await self._write(self._changes(dirty))
+            except asyncio.CancelledError:
+                self.dirty |= dirty
+                self.pending_deltas += pending
+                raise
+            except Exception:
+                # put the keys back so the next flush retries them
+                self.dirty |= dirty
+                self.pending_deltas += pending
+                print("xp flush error:", traceback.format_exc())
+                return
+            took = time.perf_counter() - t0
+            metrics.observe("bot_storage_flush_seconds", took, store="xp")
+            self.flush_count += 1
+            self.last_flush_seconds = took
+            self.total_flush_seconds += took
+
+    def flush_sync(self):
+        # used on shutdown, after the loop has stopped
+        if not self.dirty:
+            return
+        t0 = time.perf_counter()
+        changes = self._changes(self.dirty)
+        if isinstance(storage, SQLiteStorage):
+            storage.upsert_sync("xp", changes)
+        else:
+            self.log_bytes += append_xp_log(XP_LOG_FILE, changes)
+        took = time.perf_counter() - t0
+        self.dirty.clear()
+        self.pending_deltas = 0
+        self.flush_count += 1
+        self.last_flush_seconds = took
+        self.total_flush_seconds += took
+
+    def stats(self):
+        return {
+            "guilds": len(self.guilds),
+            "members": sum(len(g) for g in self.guilds.values()),
+            "bytes": sum(g.nbytes() for g in self.guilds.values()),
+            "log_bytes": self.log_bytes,
+            "fold_count": self.fold_count,
+            "pending_deltas": self.pending_deltas,
+            "dirty_keys": len(self.dirty),
+            "flush_count": self.flush_count,
+            "last_flush_seconds": self.last_flush_seconds,
+            "total_flush_seconds": self.total_flush_seconds,
+        }
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task and not self._task.done():
+            return
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._lock is not None:
+            await self.flush()
+
+class RankIndex:
+    # Per-guild ordered index for leaderboards. Each member is one packed int
+    # (-xp << 64) + user_id in a SortedList, so ascending order is "most XP
+    # first, lowest id on ties" and rank/top-N lookups are O(log n). A guild's
+    # list is built from the XP columns the first time it is ranked, so
+    # guilds nobody asks about cost nothing beyond their columns.
+    MASK = (1 << 64) - 1
+
+    def __init__(self, store):
+        self.store = store
+        self.guilds = {}
+
+    @staticmethod
+    def _key(uid, xp):
+        return (-xp << 64) + uid
+
+    def reset(self):
+        self.guilds = {}
+
+    def _sorted(self, gid):
+        sl = self.guilds.get(gid)
+        if sl is None:
+            g = self.store.guilds.get(gid)
+            if g is None:
+                return None
+            sl = self.guilds[gid] = SortedList((-xp << 64) + uid for uid, xp in zip(g.ids, g.xp))
+        return sl
+
+    def update(self, gid, uid, old_xp, new_xp):
+        sl = self.guilds.get(gid)
+        if sl is None:
+            return  # built on demand from the store, which is updated next
+        if old_xp is not None:
+            sl.discard(self._key(uid, old_xp))
+        sl.add(self._key(uid, new_xp))
+
+    def rank(self, gid, uid, xp):
+        sl = self._sorted(gid)
+        key = self._key(uid, xp)
+        if not sl or key not in sl:
+            return None
+        return sl.index(key) + 1
+
+    def size(self, gid):
+        return self.store.size(gid)
+
+    def top(self, gid, offset=0, limit=10):
+        sl = self._sorted(gid)
+        if not sl:
+            return []
+        return [(k & self.MASK, -(k >> 64)) for k in sl.islice(offset, offset + limit)]
+
+xp_store = XPStore()
+xp_ranks = RankIndex(xp_store)
+
 def load_xp():
-    global xp_data
-    xp_data = ensure_json(XP_FILE, {})
+    xp_store.load()
+    xp_ranks.reset()
 
 def save_xp():
-    save_json(XP_FILE, xp_data)
+    xp_store.flush_sync()
 
 def xp_to_level(xp):
-    lvl = 0
-    while xp >= (50 * lvl * lvl + 50 * lvl):
-        lvl += 1
-    return lvl
+    # level = 1 + the largest k with 50*k*(k+1) <= xp (what the old
+    # "while xp >= 50*lvl*lvl + 50*lvl" loop counted up to)
+    if xp < 0:
+        return 0
+    return (math.isqrt(4 * (xp // 50) + 1) - 1) // 2 + 1
+
+def level_to_xp(level):
+    # minimum total xp needed to be at `level` (inverse of xp_to_level)
+    if level <= 0:
+        return 0
+    return 50 * level * (level - 1)
 
+@timed("bot_function_seconds", "xp_add_message")
 def xp_add_message(member: discord.Member):
     if member.bot: return
-    gid = str(member.guild.id)
-    uid = str(member.id)
-    key = f"{gid}-{uid}"
-    entry = xp_data.get(key, {"xp": 0, "level": 0})
+    gid = member.guild.id
+    uid = member.id
+    entry = xp_store.get(gid, uid)
+    old_xp, level = entry if entry else (None, 0)
     gain = random.randint(8, 16)
-    entry["xp"] += gain
-    new_lvl = xp_to_level(entry["xp"])
-    if new_lvl > entry.get("level", 0):
-        entry["level"] = new_lvl
+    xp = min((old_xp or 0) + gain, XP_MAX)
+    xp_ranks.update(gid, uid, old_xp, xp)
+    new_lvl = xp_to_level(xp)
+    if new_lvl > level:
+        level = new_lvl
         # Level up announcements (try system channel, fallback to guild default, else ignore)
         try:
             gcfg = guild_config(member.guild.id)
             msg = f"🎉 {member.mention} leveled up to **{new_lvl}**!"
             # send to log channel if exists otherwise system channel
             dest = None
-            if gcfg.get("log_channel"):
-                dest = member.guild.get_channel(int(gcfg["log_channel"]))
+            if gcfg.log_channel:
+                dest = member.guild.get_channel(gcfg.log_channel)
             if not dest and member.guild.system_channel:
                 dest = member.guild.system_channel
             if dest:
@@ -137,22 +1661,107 @@ def xp_add_message(member: discord.Member):
         except Exception:
             pass
         # role rewards
-        gcfg = guild_config(member.guild.id)
-        rewards = gcfg.get("level_rewards", {})
-        rid = rewards.get(str(new_lvl))
+        rid = guild_config(member.guild.id).level_rewards.get(new_lvl)
         if rid:
-            role = member.guild.get_role(int(rid))
+            role = member.guild.get_role(rid)
             if role:
                 try:
                     asyncio.create_task(member.add_roles(role))
                 except:
                     pass
-    xp_data[key] = entry
-    save_xp()
+    xp_store.set(gid, uid, xp, level)
 
 # ---------------------------
 # Ticket system (button)
 # ---------------------------
+# Transcripts are streamed page by page (100 messages per history request) to
+# a compressed file; the blocking writes run in the default executor, so
+# memory stays flat however long the ticket is.
+TRANSCRIPT_FORMATS = ("txt", "jsonl", "html")
+TRANSCRIPT_PAGE = 100
+
+def _open_transcript(base):
+    if zstandard is not None:
+        path = base + ".zst"
+        return path, zstandard.ZstdCompressor(level=10).stream_writer(open(path, "wb"))
+    path = base + ".gz"
+    return path, gzip.open(path, "wb", compresslevel=6)
+
+def _transcript_line(m: discord.Message, fmt):
+    t = m.created_at.strftime("%Y-%m-%d %H:%M:%S")
+    edited = m.edited_at.strftime("%Y-%m-%d %H:%M:%S") if m.edited_at else None
+    if fmt == "jsonl":
+        return json.dumps({
+            "id": m.id,
+            "time": t,
+            "edited": edited,
+            "author_id": m.author.id,
+            "author": str(m.author),
+            "content": m.content or "",
+            "attachments": [a.url for a in m.attachments],
+            "embeds": [e.to_dict() for e in m.embeds],
+        }, ensure_ascii=False) + "\n"
+    extras = [f"📎 {a.url}" for a in m.attachments]
+    extras += [f"[embed] {e.title or ''} {e.description or ''}".rstrip() for e in m.embeds]
+    if fmt == "html":
+        body = html.escape(m.content or "").replace("\n", "<br>")
+        body += "".join(f"<div class=x>{html.escape(x)}</div>" for x in extras)
+        if edited:
+            body += f" <i>(edited {edited})</i>"
+        return f"<tr><td>{t}</td><td>{html.escape(str(m.author))}</td><td>{body}</td></tr>\n"
+    line = f"[{t}] {m.author}: {m.content or ''}"
+    if edited:
+        line += f" (edited {edited})"
+    return line + "".join(f"\n    {x}" for x in extras) + "\n"
+
+async def export_transcript(channel: discord.TextChannel, fmt="txt"):
+    if fmt not in TRANSCRIPT_FORMATS:
+        fmt = "txt"
+    loop = asyncio.get_running_loop()
+    base = os.path.join(TICKETS_DIR, f"{channel.guild.id}_{channel.id}.{fmt}")
+    path, fh = await loop.run_in_executor(None, _open_transcript, base)
+    count = 0
+    try:
+        if fmt == "html":
+            head = (f"<!doctype html><meta charset=utf-8><title>{html.escape(channel.name)}</title>"
+                    "<style>td{vertical-align:top;padding:2px 6px}.x{color:#666}</style><table>\n")
+            await loop.run_in_executor(None, fh.write, head.encode("utf-8"))
+        buf = []
+        async for m in channel.history(limit=None, oldest_first=True):
+            buf.append(_transcript_line(m, fmt))
+            count += 1
+            if len(buf) >= TRANSCRIPT_PAGE:
+                data = "".join(buf).encode("utf-8")
+                buf.clear()
+                await loop.run_in_executor(None, fh.write, data)
+        if fmt == "html":
+            buf.append("</table>\n")
+        if buf:
+            await loop.run_in_executor(None, fh.write, "".join(buf).encode("utf-8"))
+    finally:
+        await loop.run_in_executor(None, fh.close)
+    return path, count
+
+async def close_ticket_channel(channel: discord.TextChannel, closed_by):
+    gcfg = guild_config(channel.guild.id)
+    try:
+        path, count = await export_transcript(channel, gcfg.transcript_format)
+    except Exception:
+        print("transcript error:", traceback.format_exc())
+        path, count = None, 0
+    # send transcript to log channel if set
+    if gcfg.log_channel and path:
+        logch = channel.guild.get_channel(gcfg.log_channel)
+        if logch:
+            try:
+                await logch.send(f"📄 Ticket {channel.name} closed by {closed_by} ({count} messages). Transcript:", file=discord.File(path))
+            except:
+                pass
+    try:
+        await channel.delete()
+    except Exception:
+        print("ticket delete error:", traceback.format_exc())
+
 class TicketCloseView(View):
     def __init__(self, channel_id):
         super().__init__(timeout=None)
@@ -164,27 +1773,9 @@ class TicketCloseView(View):
         if not channel:
             await interaction.response.send_message("Channel not found.", ephemeral=True)
             return
-        # transcript
-        msgs = []
-        async for m in channel.history(limit=1000, oldest_first=True):
-            t = m.created_at.strftime("%Y-%m-%d %H:%M:%S")
-            content = m.content or ""
-            msgs.append(f"[{t}] {m.author}: {content}")
-        transcript = "\n".join(msgs)
-        tfile = os.path.join(TICKETS_DIR, f"{channel.guild.id}_{channel.id}.txt")
-        with open(tfile, "w", encoding="utf-8") as f:
-            f.write(transcript)
-        # send transcript to log channel if set
-        gcfg = guild_config(channel.guild.id)
-        lid = gcfg.get("log_channel")
-        if lid:
-            logch = channel.guild.get_channel(int(lid))
-            if logch:
-                try:
-                    await logch.send(f"📄 Ticket {channel.name} closed by {interaction.user}. Transcript:", file=discord.File(tfile))
-                except:
-                    pass
-        await channel.delete()
+        # answer right away; the transcript export and channel delete finish in the background
+        await interaction.response.send_message("🔒 Closing ticket, saving transcript…")
+        spawn(close_ticket_channel(channel, interaction.user))
 
 class TicketCreateView(View):
     def __init__(self):
@@ -194,16 +1785,15 @@ class TicketCreateView(View):
     async def create_ticket(self, interaction: discord.Interaction, button: discord.ui.Button):
         guild = interaction.guild
         gcfg = guild_config(guild.id)
-        category_id = gcfg.get("ticket_category")
-        category = guild.get_channel(int(category_id)) if category_id else None
-        staff_role_id = gcfg.get("staff_role")
+        category = guild.get_channel(gcfg.ticket_category) if gcfg.ticket_category else None
+        staff_role_id = gcfg.staff_role
         overwrites = {
             guild.default_role: discord.PermissionOverwrite(view_channel=False),
             interaction.user: discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True),
             guild.me: discord.PermissionOverwrite(view_channel=True)
         }
         if staff_role_id:
-            r = guild.get_role(int(staff_role_id))
+            r = guild.get_role(staff_role_id)
             if r:
                 overwrites[r] = discord.PermissionOverwrite(view_channel=True, send_messages=True, read_message_history=True)
         base = f"ticket-{interaction.user.name}".lower()
@@ -218,8 +1808,31 @@ class TicketCreateView(View):
 # ---------------------------
 # Reaction role system
 # ---------------------------
-def save_reaction_panels():
-    save_json(REACTION_FILE, reaction_panels)
+def save_reaction_panels(message_id):
+    storage.mark("reaction_panels", message_id)
+
+def panel_message(guild: discord.Guild, message_id, panel):
+    # PartialMessage for a panel we know the channel of (no REST call)
+    cid = panel.get("channel")
+    if not cid:
+        return None
+    ch = guild.get_channel(int(cid)) or bot.get_partial_messageable(int(cid), guild_id=guild.id)
+    return ch.get_partial_message(int(message_id))
+
+async def find_panel_message(guild: discord.Guild, message_id, panel):
+    m = panel_message(guild, message_id, panel)
+    if m is not None:
+        return m
+    # panels created before the channel id was recorded: search once, then remember it
+    for ch in guild.text_channels:
+        try:
+            m = await ch.fetch_message(int(message_id))
+        except:
+            continue
+        panel["channel"] = str(ch.id)
+        save_reaction_panels(message_id)
+        return m
+    return None
 
 class ReactionRoleView(View):
     def __init__(self, message_id):
@@ -234,6 +1847,7 @@ class ReactionRoleView(View):
                 pass
 
 @bot.event
+@timed("bot_event_seconds", "on_interaction")
 async def on_interaction(interaction: discord.Interaction):
     try:
         data = getattr(interaction, "data", None)
@@ -251,15 +1865,16 @@ async def on_interaction(interaction: discord.Interaction):
             if role in member.roles:
                 await member.remove_roles(role)
                 await interaction.followup.send(f"❎ Removed **{role.name}**.", ephemeral=True)
-                log_action(guild, f"🎭 Reaction role removed: {member} - {role.name}")
+                log_action(guild, f"🎭 Reaction role removed: {member} - {role.name}", LOG_LOW)
             else:
                 await member.add_roles(role)
                 await interaction.followup.send(f"✅ Added **{role.name}**.", ephemeral=True)
-                log_action(guild, f"🎭 Reaction role added: {member} - {role.name}")
+                log_action(guild, f"🎭 Reaction role added: {member} - {role.name}", LOG_LOW)
     except Exception:
         print("on_interaction error:", traceback.format_exc())
 
 @bot.event
+@timed("bot_event_seconds", "on_raw_reaction_add")
 async def on_raw_reaction_add(payload):
     try:
         if str(payload.message_id) not in reaction_panels: return
@@ -275,11 +1890,12 @@ async def on_raw_reaction_add(payload):
         role = g.get_role(int(rid))
         if role:
             await member.add_roles(role)
-            log_action(g, f"🎭 Reaction role added: {member} - {role.name}")
+            log_action(g, f"🎭 Reaction role added: {member} - {role.name}", LOG_LOW)
     except Exception:
         print("on_raw_reaction_add error:", traceback.format_exc())
 
 @bot.event
+@timed("bot_event_seconds", "on_raw_reaction_remove")
 async def on_raw_reaction_remove(payload):
     try:
         if str(payload.message_id) not in reaction_panels: return
@@ -295,120 +1911,982 @@ async def on_raw_reaction_remove(payload):
         role = g.get_role(int(rid))
         if role:
             await member.remove_roles(role)
-            log_action(g, f"🎭 Reaction role removed: {member} - {role.name}")
+            log_action(g, f"🎭 Reaction role removed: {member} - {role.name}", LOG_LOW)
     except Exception:
         print("on_raw_reaction_remove error:", traceback.format_exc())
 
 # ---------------------------
-# Warnings, Timeouts, Tiered discipline
+# Infractions ledger, Tiered discipline
 # ---------------------------
-def load_warnings():
-    global warnings_data
-    warnings_data = ensure_json(WARN_FILE, {})
-    return warnings_data
+# Every warn/timeout/kick/ban/clear is one JSON line appended to
+# infractions.jsonl, scoped by (guild, user). The whole log is indexed in
+# memory per (guild, user) at startup, so lookups and the auto-ban threshold
+# never touch the file; new records are appended in batches off the loop and a
+# background compaction rewrites the file without expired or cleared entries.
+# Appends and compaction take an flock so clusters can share one file.
+INFRACTIONS_FILE = "infractions.jsonl"
+INFRACTION_TYPES = ("warn", "timeout", "kick", "ban", "clear")
+WARN_EXPIRY_DAYS = float(os.getenv("WARN_EXPIRY_DAYS", "90"))                # 0 = warnings never expire
+INFRACTION_RETENTION_DAYS = float(os.getenv("INFRACTION_RETENTION_DAYS", "365"))  # 0 = keep forever
+INFRACTION_COMPACT_HOURS = 6
+AUTO_BAN_WARNINGS = 5   # active warnings in one guild before an auto-ban
+AUTO_WARN_TIMEOUTS = 3  # timeouts in one guild before each further one adds a warning
+
+class _LedgerLock:
+    # exclusive flock on a side file; a no-op where fcntl is unavailable
+    def __init__(self, path):
+        self.path = path + ".lock"
+        self.fd = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self.fd is not None:
+            os.close(self.fd)  # releases the lock
+            self.fd = None
+
+def _iso_to_ts(text):
+    try:
+        return int(datetime.datetime.strptime(text, "%Y-%m-%d %H:%M:%S").replace(tzinfo=datetime.timezone.utc).timestamp())
+    except (TypeError, ValueError):
+        return None
+
+class _UserInfractions:
+    __slots__ = ("records", "warns", "timeouts")
+
+    def __init__(self):
+        self.records = []                   # chronological; warnings before the last clear are dropped
+        self.warns = collections.deque()    # timestamps of warnings since the last clear
+        self.timeouts = collections.deque() # timestamps of timeouts
+
+class InfractionLedger:
+    def __init__(self, path=INFRACTIONS_FILE):
+        self.path = path
+        self.index = {}    # (guild id, user id) -> _UserInfractions
+        self.pending = []  # encoded lines not yet appended
+        self._flush_task = None
+        self._lock = None
+
+    # -- index ------------------------------------------------------------
+    @staticmethod
+    def _cutoff(days, now):
+        return now - days * 86400 if days > 0 else None
+
+    def _apply(self, rec):
+        key = (rec["guild"], rec["user"])
+        entry = self.index.get(key)
+        if entry is None:
+            entry = self.index[key] = _UserInfractions()
+        kind = rec["type"]
+        if kind == "clear":
+            entry.records = [r for r in entry.records if r["type"] != "warn"]
+            entry.warns.clear()
+        elif kind == "warn":
+            entry.warns.append(rec["ts"])
+        elif kind == "timeout":
+            entry.timeouts.append(rec["ts"])
+        entry.records.append(rec)
+
+    def get(self, guild_id, user_id):
+        return self.index.get((int(guild_id), int(user_id)))
+
+    def history(self, guild_id, user_id, kind=None):
+        entry = self.get(guild_id, user_id)
+        if entry is None:
+            return []
+        return [r for r in entry.records if kind is None or r["type"] == kind]
 
-def save_warnings(data):
-    save_json(WARN_FILE, data)
+    def _count_recent(self, dq, now=None):
+        # expired timestamps sit at the left; dropping them keeps this O(1) amortized
+        cutoff = self._cutoff(WARN_EXPIRY_DAYS, time.time() if now is None else now)
+        if cutoff is not None:
+            while dq and dq[0] < cutoff:
+                dq.popleft()
+        return len(dq)
 
-def load_timeouts():
-    global timeouts_data
-    timeouts_data = ensure_json(TIMEOUTS_FILE, {})
-    return timeouts_data
+    def active_warnings(self, guild_id, user_id, now=None):
+        entry = self.get(guild_id, user_id)
+        return self._count_recent(entry.warns, now) if entry else 0
 
-def save_timeouts(data):
-    save_json(TIMEOUTS_FILE, data)
+    def recent_timeouts(self, guild_id, user_id, now=None):
+        entry = self.get(guild_id, user_id)
+        return self._count_recent(entry.timeouts, now) if entry else 0
+
+    def schedule_expiry(self, guild_id, user_id):
+        # One in-memory job per (guild, user) for the oldest active warning;
+        # the ledger is the source of truth, so these are rebuilt at startup
+        # instead of being persisted.
+        entry = self.get(guild_id, user_id)
+        if WARN_EXPIRY_DAYS <= 0 or entry is None or not self._count_recent(entry.warns):
+            return
+        scheduler.add("warn_expiry", entry.warns[0] + WARN_EXPIRY_DAYS * 86400, guild_id,
+                      key=user_id, persist=False, user=int(user_id))
+
+    def schedule_expiries(self):
+        for guild_id, user_id in list(self.index):
+            self.schedule_expiry(guild_id, user_id)
+
+    def is_expired(self, rec, now=None):
+        cutoff = self._cutoff(WARN_EXPIRY_DAYS, time.time() if now is None else now)
+        return cutoff is not None and rec["ts"] < cutoff
+
+    def add(self, guild_id, user_id, kind, moderator, reason="", **extra):
+        assert kind in INFRACTION_TYPES, kind
+        rec = {"guild": int(guild_id), "user": int(user_id), "type": kind,
+               "moderator": str(moderator), "reason": reason, "time": now_iso(), "ts": int(time.time())}
+        rec.update(extra)
+        self._apply(rec)
+        self.pending.append(json.dumps(rec, ensure_ascii=False) + "\n")
+        if kind == "warn" and self.active_warnings(guild_id, user_id) == 1:
+            # later warnings are picked up when this one expires
+            self.schedule_expiry(guild_id, user_id)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return rec  # flushed on shutdown
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._flush_later())
+        return rec
+
+    # -- file -------------------------------------------------------------
+    def _owned(self, guild_id):
+        # in a shard cluster only this process's guilds are indexed
+        if not (SHARD_COUNT and SHARD_IDS) or not guild_id:
+            return True
+        return (guild_id >> 22) % SHARD_COUNT in SHARD_IDS
+
+    def load(self):
+        with _LedgerLock(self.path):
+            if not os.path.exists(self.path):
+                self._migrate()
+            bad = 0
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                        if rec["type"] in INFRACTION_TYPES and self._owned(rec["guild"]):
+                            self._apply(rec)
+                    except (ValueError, KeyError, TypeError):
+                        bad += 1
+        if bad:
+            print(f"⚠️ Skipped {bad} unreadable lines in {self.path}")
+
+    def _migrate(self):
+        # one-time import of the user-keyed warnings/timeouts documents. They
+        # carry no guild, so they go to the only configured guild when there
+        # is exactly one (counted over all clusters' guilds, not just ours),
+        # else to guild 0 (shown, but never counted).
+        guilds = storage.all_guild_ids()
+        gid = guilds[0] if len(guilds) == 1 else 0
+        records = []
+        for kind, src, stamp in (("warn", "warnings", "time"), ("timeout", "timeouts", "timestamp")):
+            doc = storage.load(src)
+            for uid, items in doc.items():
+                for item in items or []:
+                    rec = {"guild": gid, "user": int(uid), "type": kind,
+                           "moderator": item.get("moderator", "?"), "reason": item.get("reason", ""),
+                           "time": item.get(stamp) or now_iso()}
+                    rec["ts"] = _iso_to_ts(rec["time"]) or int(time.time())
+                    if kind == "timeout":
+                        rec["duration"] = item.get("duration", "?")
+                    records.append(rec)
+            storage.docs.pop(src, None)  # the legacy documents are left on disk untouched
+        records.sort(key=lambda r: r["ts"])
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        if records:
+            print(f"Migrated {len(records)} warnings/timeouts into {self.path} (guild {gid or 'unscoped'})")
+
+    def _append(self, lines):
+        with _LedgerLock(self.path):
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+
+    async def _flush_later(self):
+        await asyncio.sleep(STORAGE_FLUSH_DELAY)
+        await self.flush()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        lines, self.pending = self.pending, []
+        started = []
+
+        def append():
+            started.append(True)
+            self._append(lines)
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, append)
+        except asyncio.CancelledError:
+            # shutdown: unless the append is already running (it finishes on
+            # its own), leave the lines for flush_sync()
+            if not started:
+                self.pending[:0] = lines
+            raise
+        except Exception:
+            self.pending[:0] = lines
+            print("infractions flush error:", traceback.format_exc())
+
+    def flush_sync(self):
+        if self.pending:
+            lines, self.pending = self.pending, []
+            self._append(lines)
+
+    def _compact_file(self, now):
+        # rewrite the whole file (every guild, not only ours) minus records
+        # past retention and warnings superseded by a later clear
+        cutoff = self._cutoff(INFRACTION_RETENTION_DAYS, now)
+        with _LedgerLock(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+            parsed, last_clear = [], {}
+            for line in lines:
+                try:
+                    rec = json.loads(line)
+                    key = (rec["guild"], rec["user"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+                parsed.append((rec, line))
+                if rec.get("type") == "clear":
+                    last_clear[key] = len(parsed)
+            kept = [line if line.endswith("\n") else line + "\n"
+                    for i, (rec, line) in enumerate(parsed, start=1)
+                    if not (cutoff is not None and rec.get("ts", 0) < cutoff)
+                    and not (rec.get("type") == "warn" and last_clear.get((rec["guild"], rec["user"]), 0) > i)]
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.writelines(kept)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        return len(lines), len(kept)
+
+    def _prune_index(self, now):
+        cutoff = self._cutoff(INFRACTION_RETENTION_DAYS, now)
+        if cutoff is None:
+            return
+        for key in list(self.index):
+            entry = self.index[key]
+            if entry.records and entry.records[0]["ts"] < cutoff:
+                entry.records = [r for r in entry.records if r["ts"] >= cutoff]
+                if not entry.records:
+                    del self.index[key]
+
+    async def compact(self):
+        await self.flush()
+        now = time.time()
+        before, after = await asyncio.get_running_loop().run_in_executor(None, self._compact_file, now)
+        self._prune_index(now)
+        if before != after:
+            print(f"🧹 Compacted {self.path}: {before} -> {after} records")
+
+infractions = InfractionLedger()
+
+@tasks.loop(hours=INFRACTION_COMPACT_HOURS)
+async def infraction_compactor():
+    try:
+        await infractions.compact()
+    except Exception:
+        print("infraction compaction error:", traceback.format_exc())
 
 async def check_auto_ban(guild: discord.Guild, member: discord.Member):
-    warnings = load_warnings()
-    uid = str(member.id)
-    total = len(warnings.get(uid, []))
-    if total >= 5:
+    total = infractions.active_warnings(guild.id, member.id)
+    if total >= AUTO_BAN_WARNINGS:
         try:
-            await member.ban(reason="Auto-ban: exceeded 5 warnings")
-            log_action(guild, f"🚫 Auto-ban: {member} (warnings: {total})")
+            await member.ban(reason=f"Auto-ban: exceeded {AUTO_BAN_WARNINGS} warnings")
+            log_action(guild, f"🚫 Auto-ban: {member} (warnings: {total})", LOG_HIGH)
+            send_dm(member, f"🚫 You were automatically banned from **{guild.name}** after receiving {total} warnings.")
+            infractions.add(guild.id, member.id, "ban", "Auto-Mod", f"{total} warnings")
+            infractions.add(guild.id, member.id, "clear", "Auto-Mod", "auto-ban")
+        except Exception:
+            log_action(guild, f"⚠️ Auto-ban failed for {member} (missing perms?)")
+
+# ---------------------------
+# Scheduler (temp-bans, temp-roles, warning expiry)
+# ---------------------------
+# Due actions live in the "scheduled" storage kind (job id -> job) so they
+# survive restarts, and in a min-heap of (due, id) for ordering. One task
+# sleeps until the earliest deadline; adding an earlier job wakes it. Removed
+# or rescheduled jobs are not dug out of the heap: entries whose job no longer
+# matches are skipped when they surface. Jobs that can be derived from other
+# state (warning expiry, from the infractions ledger) are added with
+# persist=False and only live in memory.
+SCHEDULER_MAX_SLEEP = 300    # re-check the wall clock at least this often
+SCHEDULER_RETRY_DELAY = 300  # seconds before retrying a job that failed
+SCHEDULER_MAX_ATTEMPTS = 5
+
+class Scheduler:
+    def __init__(self):
+        self.jobs = {}
+        self.transient = {}  # jobs derived from other state, never persisted
+        self.heap = []
+        self.handlers = {}
+        self._wake = None
+        self._task = None
+        self.ran = 0
+        self.failed = 0
+
+    def load(self):
+        self.jobs = storage.load("scheduled")
+        # warning expiry used to be persisted per warning; it is rebuilt from
+        # the infractions ledger now
+        legacy = [jid for jid, job in self.jobs.items() if job["action"] == "warn_expiry"]
+        for jid in legacy:
+            self.cancel(jid)
+        self.heap = [(job["due"], jid) for jid, job in self.jobs.items()]
+        self.heap += [(job["due"], jid) for jid, job in self.transient.items()]
+        heapq.heapify(self.heap)
+
+    def _job(self, jid):
+        job = self.jobs.get(jid)
+        return job if job is not None else self.transient.get(jid)
+
+    def action(self, name):
+        # decorator registering `async def handler(job)` for jobs of this action
+        def deco(fn):
+            self.handlers[name] = fn
+            return fn
+        return deco
+
+    def add(self, action, due, guild_id, key=None, persist=True, **data):
+        # a job with the same action/guild/key replaces the earlier one;
+        # persist=False keeps it in memory only
+        jid = f"{action}:{guild_id}:{key}" if key is not None else f"{action}:{guild_id}:{time.time_ns()}"
+        job = {"action": action, "due": float(due), "guild": int(guild_id), "attempts": 0}
+        job.update(data)
+        if persist:
+            self.jobs[jid] = job
+            storage.mark("scheduled", jid)
+        else:
+            self.transient[jid] = job
+        heapq.heappush(self.heap, (job["due"], jid))
+        if len(self.heap) > 2 * (len(self.jobs) + len(self.transient)) + 1000:
+            # mostly stale entries from replaced/cancelled jobs: rebuild
+            self.heap = [(j["due"], k) for jobs in (self.jobs, self.transient) for k, j in jobs.items()]
+            heapq.heapify(self.heap)
+        if self.heap[0][1] == jid and self._wake is not None:
+            self._wake.set()  # new earliest deadline
+        return jid
+
+    def cancel(self, jid):
+        if self.jobs.pop(jid, None) is not None:
+            storage.mark("scheduled", jid)
+            return True
+        return self.transient.pop(jid, None) is not None
+
+    def pending(self, action=None, guild_id=None):
+        return [(jid, job) for jid, job in self.jobs.items()
+                if (action is None or job["action"] == action) and (guild_id is None or job["guild"] == guild_id)]
+
+    def start(self):
+        if self._task and not self._task.done():
+            return
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        await bot.wait_until_ready()  # handlers need the guild cache
+        while True:
+            now = time.time()
+            while self.heap and self.heap[0][0] <= now:
+                due, jid = heapq.heappop(self.heap)
+                job = self._job(jid)
+                if job is None or job["due"] != due:
+                    continue  # cancelled or rescheduled
+                spawn(self._execute(jid, job))
+            delay = SCHEDULER_MAX_SLEEP if not self.heap else min(SCHEDULER_MAX_SLEEP, self.heap[0][0] - now)
+            self._wake.clear()
             try:
-                await member.send(f"🚫 You were automatically banned from **{guild.name}** after receiving {total} warnings.")
-            except:
+                await asyncio.wait_for(self._wake.wait(), timeout=max(0.0, delay))
+            except asyncio.TimeoutError:
                 pass
-            warnings.pop(uid, None)
-            save_warnings(warnings)
+
+    async def _execute(self, jid, job):
+        handler = self.handlers.get(job["action"])
+        try:
+            if handler is not None:
+                await handler(job)
+            self.ran += 1
         except Exception:
-            log_action(guild, f"⚠️ Auto-ban failed for {member} (missing perms?)")
+            self.failed += 1
+            job["attempts"] = job.get("attempts", 0) + 1
+            if job["attempts"] < SCHEDULER_MAX_ATTEMPTS and self._job(jid) is job:
+                job["due"] = time.time() + SCHEDULER_RETRY_DELAY
+                if jid in self.jobs:
+                    storage.mark("scheduled", jid)
+                heapq.heappush(self.heap, (job["due"], jid))
+                return
+            print(f"scheduled job {jid} failed:", traceback.format_exc())
+        if self._job(jid) is job:
+            self.cancel(jid)
+
+    def stats(self):
+        return {"pending": len(self.jobs), "transient": len(self.transient), "heap": len(self.heap),
+                "ran": self.ran, "failed": self.failed}
+
+scheduler = Scheduler()
+
+@scheduler.action("unban")
+async def _scheduled_unban(job):
+    guild = bot.get_guild(job["guild"])
+    if guild is None:
+        return  # bot left the guild
+    try:
+        await guild.unban(discord.Object(id=job["user"]), reason="Temporary ban expired")
+    except discord.NotFound:
+        return  # already unbanned by hand
+    log_action(guild, f"⌛ Temp-ban expired: <@{job['user']}> unbanned")
+
+@scheduler.action("remove_role")
+async def _scheduled_remove_role(job):
+    guild = bot.get_guild(job["guild"])
+    if guild is None:
+        return
+    member = guild.get_member(job["user"])
+    role = guild.get_role(job["role"])
+    if member is None or role is None or role not in member.roles:
+        return  # left, role deleted, or already removed
+    await member.remove_roles(role, reason="Temporary role expired")
+    log_action(guild, f"⌛ Temp-role expired: {role.name} removed from {member}", LOG_LOW)
+
+@scheduler.action("warn_expiry")
+async def _scheduled_warn_expiry(job):
+    entry = infractions.get(job["guild"], job["user"])
+    if entry is None:
+        return
+    before = len(entry.warns)
+    after = infractions.active_warnings(job["guild"], job["user"])
+    guild = bot.get_guild(job["guild"])
+    if after < before and guild is not None:
+        log_action(guild, f"⌛ {before - after} warning(s) for <@{job['user']}> expired ({after} still active)", LOG_LOW)
+    infractions.schedule_expiry(job["guild"], job["user"])
 
 # ---------------------------
-# Auto-moderation (anti-link, anti-spam, caps) and XP granting
+# Ban index (/unban by name, /unban_bulk)
 # ---------------------------
-user_message_times = {}
+# A guild's ban list is fetched once, on the first /unban that needs names,
+# and then kept current from on_member_ban/on_member_unban. Lookups by id,
+# username or global name are dict hits; prefix search for autocomplete walks
+# a SortedList of (lowercased name, user id).
+UNBAN_CONCURRENCY = 5
+AUTOCOMPLETE_LIMIT = 25
+
+class _GuildBans:
+    __slots__ = ("users", "names", "sorted", "ready", "building", "removed")
+
+    def __init__(self):
+        self.users = {}      # user id -> (name, global name)
+        self.names = {}      # lowercased username/global name -> set of user ids
+        self.sorted = SortedList()
+        self.ready = False
+        self.building = None  # task fetching the ban list
+        self.removed = set()  # unbanned while the build was running
+
+    def add(self, user):
+        if user.id in self.users:
+            self.discard(user.id)
+        names = (user.name, getattr(user, "global_name", None))
+        self.users[user.id] = names
+        for name in {n.lower() for n in names if n}:
+            self.names.setdefault(name, set()).add(user.id)
+            self.sorted.add((name, user.id))
+
+    def discard(self, user_id):
+        names = self.users.pop(user_id, None)
+        if names is None:
+            return False
+        for name in {n.lower() for n in names if n}:
+            ids = self.names.get(name)
+            if ids is not None:
+                ids.discard(user_id)
+                if not ids:
+                    del self.names[name]
+            self.sorted.discard((name, user_id))
+        return True
+
+    def label(self, user_id):
+        name, global_name = self.users[user_id]
+        return f"{name} ({global_name})" if global_name and global_name != name else name
+
+class BanIndex:
+    def __init__(self):
+        self.guilds = {}
+
+    def _entry(self, guild_id):
+        entry = self.guilds.get(guild_id)
+        if entry is None:
+            entry = self.guilds[guild_id] = _GuildBans()
+        return entry
+
+    def start_build(self, guild):
+        entry = self._entry(guild.id)
+        if not entry.ready and (entry.building is None or entry.building.done()):
+            entry.building = spawn(self._build(guild, entry))
+        return entry
+
+    async def ensure(self, guild):
+        entry = self.start_build(guild)
+        if not entry.ready:
+            await asyncio.shield(entry.building)
+            if not entry.ready:
+                raise RuntimeError(f"could not fetch the ban list of guild {guild.id}")
+        return entry
+
+    async def _build(self, guild, entry):
+        entry.removed.clear()
+        try:
+            async for ban in guild.bans(limit=None):
+                # a ban lifted while we were paging must not come back
+                if ban.user.id not in entry.removed:
+                    entry.add(ban.user)
+            entry.ready = True
+        except Exception:
+            print(f"ban list fetch failed for guild {guild.id}:", traceback.format_exc())
+        finally:
+            entry.removed.clear()
+
+    def on_ban(self, guild_id, user):
+        entry = self.guilds.get(guild_id)
+        if entry is not None:
+            entry.add(user)
+
+    def on_unban(self, guild_id, user_id):
+        entry = self.guilds.get(guild_id)
+        if entry is not None:
+            entry.discard(user_id)
+            if not entry.ready:
+                entry.removed.add(user_id)
+
+    def find(self, guild_id, query):
+        # -> list of matching user ids
+        entry = self.guilds.get(guild_id)
+        query = query.strip()
+        if query.isdigit():
+            uid = int(query)
+            return [uid] if entry is None or uid in entry.users else []
+        if entry is None:
+            return []
+        name = query.lstrip("@")
+        if "#" in name:
+            name = name.rsplit("#", 1)[0]  # legacy name#1234 input
+        return sorted(entry.names.get(name.lower(), ()))
+
+    def search(self, guild_id, prefix, limit=AUTOCOMPLETE_LIMIT):
+        entry = self.guilds.get(guild_id)
+        if entry is None:
+            return []
+        prefix = prefix.strip().lower()
+        if prefix.isdigit() and int(prefix) in entry.users:
+            return [int(prefix)]
+        out = []
+        for name, uid in entry.sorted.irange((prefix, 0)):
+            if not name.startswith(prefix) or len(out) >= limit:
+                break
+            if uid not in out:
+                out.append(uid)
+        return out
+
+ban_index = BanIndex()
 
 @bot.event
-async def on_message(message: discord.Message):
-    try:
-        if message.author.bot:
-            return
+async def on_member_ban(guild: discord.Guild, user):
+    ban_index.on_ban(guild.id, user)
 
-        # Always process commands first
-        await bot.process_commands(message)
+@bot.event
+async def on_member_unban(guild: discord.Guild, user):
+    ban_index.on_unban(guild.id, user.id)
 
-        if not message.guild:
-            # allow XP in guild-only; skip DMs for auto-mod
-            return
+# ---------------------------
+# Auto-moderation (anti-link, anti-spam, caps) and XP granting
+# ---------------------------
+SPAM_MAX_MESSAGES = 5  # default: more than this many messages ...
+SPAM_WINDOW = 5        # ... within this many seconds counts as spam
+SPAM_IDLE_EVICT = 300  # drop limiter state for users idle this long
 
-        gcfg = guild_config(message.guild.id)
-        content = message.content or ""
-        lower = content.lower()
+class _SpamState:
+    # ring buffer of a user's last `limit` message times
+    __slots__ = ("times", "pos", "last")
 
-        # anti-link
-        if gcfg["filters"].get("anti_link", True):
-            if re.search(r"https?:\/\/\S+", lower):
-                try:
-                    await message.delete()
-                except:
-                    pass
-                log_action(message.guild, f"🚫 Link removed from {message.author}")
+    def __init__(self, limit):
+        self.times = array("d", bytes(8 * limit))
+        self.pos = 0
+        self.last = 0.0
+
+class SpamLimiter:
+    # Sliding-window limiter keyed by (guild_id, user_id). Each check is O(1):
+    # the slot about to be overwritten holds the time of the message `limit`
+    # messages ago, and if that is still inside the window the user has sent
+    # more than `limit` messages in it.
+    def __init__(self):
+        self.states = {}
+
+    def hit(self, guild_id, user_id, limit=SPAM_MAX_MESSAGES, window=SPAM_WINDOW, now=None):
+        now = time.monotonic() if now is None else now
+        key = (guild_id, user_id)
+        st = self.states.get(key)
+        if st is None or len(st.times) != limit:
+            st = self.states[key] = _SpamState(limit)
+        oldest = st.times[st.pos]
+        st.times[st.pos] = now
+        st.pos = (st.pos + 1) % limit
+        st.last = now
+        return oldest > 0 and now - oldest < window
+
+    def sweep(self, idle=SPAM_IDLE_EVICT, now=None):
+        now = time.monotonic() if now is None else now
+        stale = [k for k, st in self.states.items() if now - st.last > idle]
+        for k in stale:
+            del self.states[k]
+        return len(stale)
+
+spam_limiter = SpamLimiter()
+
+@tasks.loop(seconds=60)
+async def spam_sweeper():
+    spam_limiter.sweep()
+    dup_detector.sweep()
+
+# Duplicate-content raids: many accounts posting the same text once each.
+# Messages are normalized and hashed; each guild keeps an LRU of recent
+# fingerprints (bounded, oldest expire first) with the distinct authors seen
+# for each. When more than the allowed number of authors post the same
+# fingerprint inside the window, every tracked message is deleted and its
+# author timed out, and later copies are removed on sight until it expires.
+# Since ordinary chat ("happy birthday!") can match too, it is off until a
+# guild turns it on with /setdupes.
+DUP_MAX_AUTHORS = 4          # default: a 5th distinct author posting the same text trips it
+DUP_WINDOW = 60              # seconds a fingerprint is remembered after its last use
+DUP_MIN_LENGTH = 8           # normalized text shorter than this is never fingerprinted
+DUP_MAX_FINGERPRINTS = 2048  # per guild
+DUP_TIMEOUT = 600            # seconds raid accounts are timed out for
+DUP_STRIP_RE = re.compile(r"[\u200b-\u200f\u2060-\u2064\ufeff]")  # zero-width and direction marks
+DUP_SPLIT_RE = re.compile(r"[\W_]+")
+
+def normalize_content(content):
+    text = unicodedata.normalize("NFKC", content).casefold()
+    text = DUP_STRIP_RE.sub("", text)
+    return DUP_SPLIT_RE.sub(" ", text).strip()
+
+class _DupState:
+    __slots__ = ("last", "authors", "tripped")
+
+    def __init__(self):
+        self.last = 0.0
+        self.authors = {}  # author id -> (time, channel id, message id) of their latest copy, oldest first
+        self.tripped = False
+
+class DuplicateDetector:
+    def __init__(self, capacity=DUP_MAX_FINGERPRINTS):
+        self.capacity = capacity
+        self.guilds = {}  # guild id -> OrderedDict fingerprint -> _DupState (oldest first)
+        self.tripped = 0
+
+    def hit(self, message, max_authors=DUP_MAX_AUTHORS, window=DUP_WINDOW, now=None):
+        # -> None, or the list of (author id, channel id, message id) to act on
+        text = normalize_content(message.content or "")
+        if len(text) < DUP_MIN_LENGTH:
+            return None
+        now = time.monotonic() if now is None else now
+        lru = self.guilds.get(message.guild.id)
+        if lru is None:
+            lru = self.guilds[message.guild.id] = collections.OrderedDict()
+        while lru:
+            oldest = next(iter(lru.values()))
+            if now - oldest.last <= window and len(lru) < self.capacity:
+                break
+            lru.popitem(last=False)
+        fp = hash(text)
+        st = lru.get(fp)
+        if st is None:
+            st = lru[fp] = _DupState()
+        else:
+            lru.move_to_end(fp)
+        st.last = now
+        author = message.author.id
+        if st.tripped:
+            return [(author, message.channel.id, message.id)]
+        authors = st.authors
+        authors.pop(author, None)  # re-insert so the dict stays ordered by time
+        authors[author] = (now, message.channel.id, message.id)
+        # only authors who posted it within the window count, not everyone
+        # since the fingerprint was first seen
+        while now - next(iter(authors.values()))[0] > window:
+            del authors[next(iter(authors))]
+        if len(authors) <= max_authors:
+            return None
+        st.tripped = True
+        self.tripped += 1
+        hits = [(uid, cid, mid) for uid, (_, cid, mid) in authors.items()]
+        st.authors = {}
+        return hits
+
+    def sweep(self, idle=3600, now=None):
+        # drops fingerprints idle longer than the largest window /setdupes allows
+        now = time.monotonic() if now is None else now
+        for gid in list(self.guilds):
+            lru = self.guilds[gid]
+            while lru and now - next(iter(lru.values())).last > idle:
+                lru.popitem(last=False)
+            if not lru:
+                del self.guilds[gid]
+
+dup_detector = DuplicateDetector()
+
+async def dup_raid_cleanup(guild: discord.Guild, hits, current_id):
+    # delete the earlier copies (automod deletes the current one) and time
+    # out every author involved
+    until = discord.utils.utcnow() + datetime.timedelta(seconds=DUP_TIMEOUT)
+    for uid, cid, mid in hits:
+        if mid != current_id:
+            ch = guild.get_channel(cid)
+            if ch is not None:
                 try:
-                    await message.author.send(f"⚠️ Links are not allowed in {message.guild.name}.")
-                except:
+                    await ch.get_partial_message(mid).delete()
+                except discord.HTTPException:
                     pass
-                return
+        member = guild.get_member(uid)
+        if member is None or member.is_timed_out():
+            continue
+        try:
+            await member.timeout(until, reason="Duplicate-message raid")
+            infractions.add(guild.id, uid, "timeout", "Auto-Mod", "duplicate-message raid", duration=f"{DUP_TIMEOUT // 60}m")
+        except discord.HTTPException:
+            pass
+    if len(hits) > 1:
+        log_action(guild, f"🚨 Duplicate-message raid: {len(hits)} accounts posted the same message; removed and timed out", LOG_HIGH)
+
+def dup_check(max_authors, window):
+    def check(message, content):
+        hits = dup_detector.hit(message, max_authors, window)
+        if not hits:
+            return False
+        spawn(dup_raid_cleanup(message.guild, hits, message.id))
+        return True
+    return check
+
+# Each guild's `filters` config is compiled once into an ordered list of rules
+# and cached until that guild's config changes. Rules are sorted by cost;
+# anti-spam goes last because it records every message it sees.
+LINK_RE = re.compile(r"https?://\S+", re.IGNORECASE)
+MAX_BANNED_WORD_LEN = 100
+
+class AutomodRule:
+    __slots__ = ("name", "cost", "check", "log", "dm")
+
+    def __init__(self, name, cost, check, log, dm):
+        self.name = name
+        self.cost = cost
+        self.check = check  # (message, content) -> bool
+        self.log = log      # formatted with author=
+        self.dm = dm        # formatted with guild=
+
+class AutomodPipeline:
+    __slots__ = ("rules",)
+
+    def __init__(self, rules):
+        self.rules = sorted(rules, key=lambda r: r.cost)
+
+    def match(self, message, content):
+        for rule in self.rules:
+            if rule.check(message, content):
+                return rule
+        return None
+
+def _trie_pattern(words):
+    # Build one regex shaped like a trie of the words ("cat", "car" ->
+    # "ca(?:r|t)"), so matching cost per character depends on the alphabet,
+    # not on how many words are listed.
+    trie = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[""] = None
+
+    def build(node):
+        alts = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not alts:
+            return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        if "" in node:
+            body = "(?:" + body + ")?"
+        return body
+
+    return build(trie)
+
+def compile_banned_words(words):
+    words = {w.strip().lower() for w in words if w and w.strip()}
+    words = {w[:MAX_BANNED_WORD_LEN] for w in words}
+    if not words:
+        return None
+    return re.compile(r"(?<!\w)" + _trie_pattern(words) + r"(?!\w)", re.IGNORECASE)
+
+def compile_automod(guild_id, gcfg):
+    rules = []
+    if gcfg.anti_link:
+        rules.append(AutomodRule(
+            "anti_link", 1,
+            lambda m, c: "://" in c and LINK_RE.search(c) is not None,
+            "🚫 Link removed from {author}", "⚠️ Links are not allowed in {guild}."))
+    if gcfg.caps_filter:
+        rules.append(AutomodRule(
+            "caps_filter", 1,
+            lambda m, c: len(c) > 10 and c.isupper(),
+            "🧢 Caps message deleted from {author}", "🧢 Please avoid excessive caps."))
+    banned = compile_banned_words(gcfg.banned_words)
+    if banned is not None:
+        rules.append(AutomodRule(
+            "banned_words", 2,
+            lambda m, c: banned.search(c) is not None,
+            "🤐 Banned word removed from {author}", "🤐 Your message contained a word that is not allowed in {guild}."))
+    if gcfg.dup_filter:
+        rules.append(AutomodRule(
+            "duplicate_raid", 8,
+            dup_check(gcfg.dup_authors or DUP_MAX_AUTHORS, gcfg.dup_window or DUP_WINDOW),
+            "🚨 Raid duplicate removed from {author}", "🚨 Your message matched a spam wave in {guild} and was removed."))
+    if gcfg.anti_spam:
+        limit = gcfg.spam_messages or SPAM_MAX_MESSAGES
+        window = gcfg.spam_window or SPAM_WINDOW
+        rules.append(AutomodRule(
+            "anti_spam", 9,
+            lambda m, c: spam_limiter.hit(guild_id, m.author.id, limit, window),
+            "🚷 Spam: {author}", "⛔ Slow down — you're sending messages too quickly."))
+    return AutomodPipeline(rules)
+
+automod_cache = {}
+
+def automod_pipeline(guild_id, gcfg):
+    pipe = automod_cache.get(guild_id)
+    if pipe is None:
+        pipe = automod_cache[guild_id] = compile_automod(guild_id, gcfg)
+    return pipe
+
+@timed("bot_event_seconds", "process_guild_message")
+async def process_guild_message(message: discord.Message, overloaded=False):
+    # automod + XP for one guild message; when the worker is overloaded the
+    # low-priority parts (logging, XP) are skipped and only deletes happen
+    gcfg = guild_config(message.guild.id)
+    content = message.content or ""
+
+    # auto-mod: first matching rule wins
+    rule = automod_pipeline(message.guild.id, gcfg).match(message, content)
+    if rule:
+        metrics.inc("bot_automod_actions_total", rule=rule.name)
+        try:
+            await message.delete()
+        except:
+            pass
+        if not overloaded:
+            log_action(message.guild, rule.log.format(author=message.author))
+        send_dm(message.author, rule.dm.format(guild=message.guild.name))
+        return
+
+    # XP
+    if not overloaded:
+        try:
+            xp_add_message(message.author)
+        except Exception:
+            pass
+
+# Guild messages are handed to N worker queues by guild id, so each guild is
+# processed in order but a busy guild only delays the guilds sharing its
+# worker. Past EVENT_SHED_AT queued messages a worker drops XP and logging;
+# a full queue drops the message entirely.
+EVENT_WORKERS = int(os.getenv("EVENT_WORKERS", "8"))
+EVENT_QUEUE_MAX = 2000
+EVENT_SHED_AT = 500
+
+class _WorkerStats:
+    __slots__ = ("processed", "dropped", "shed", "lag", "max_lag")
+
+    def __init__(self):
+        self.processed = 0
+        self.dropped = 0
+        self.shed = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+class EventRouter:
+    def __init__(self, workers=EVENT_WORKERS, maxsize=EVENT_QUEUE_MAX, shed_at=EVENT_SHED_AT):
+        self.n = max(1, workers)
+        self.maxsize = maxsize
+        self.shed_at = shed_at
+        self.queues = []
+        self.tasks = []
+        self.worker_stats = [_WorkerStats() for _ in range(self.n)]
+
+    def start(self):
+        if self.tasks:
+            return
+        self.queues = [asyncio.Queue(self.maxsize) for _ in range(self.n)]
+        self.tasks = [asyncio.create_task(self._worker(i)) for i in range(self.n)]
+
+    def submit(self, message: discord.Message):
+        if not self.tasks:
+            self.start()
+        i = message.guild.id % self.n
+        try:
+            self.queues[i].put_nowait((time.monotonic(), message))
+        except asyncio.QueueFull:
+            self.worker_stats[i].dropped += 1
+            return False
+        return True
+
+    async def _worker(self, i):
+        q, st = self.queues[i], self.worker_stats[i]
+        while True:
+            queued_at, message = await q.get()
+            st.lag = time.monotonic() - queued_at
+            if st.lag > st.max_lag:
+                st.max_lag = st.lag
+            overloaded = q.qsize() >= self.shed_at
+            if overloaded:
+                st.shed += 1
+            try:
+                await process_guild_message(message, overloaded)
+            except Exception:
+                print("event worker error:", traceback.format_exc())
+            st.processed += 1
+
+    def stats(self):
+        return [{
+            "worker": i,
+            "depth": self.queues[i].qsize() if self.queues else 0,
+            "processed": st.processed,
+            "dropped": st.dropped,
+            "shed": st.shed,
+            "lag_seconds": st.lag,
+            "max_lag_seconds": st.max_lag,
+        } for i, st in enumerate(self.worker_stats)]
+
+event_router = EventRouter()
+
+@bot.event
+@timed("bot_event_seconds", "on_message")
+async def on_message(message: discord.Message):
+    try:
+        if message.author.bot:
+            return
 
-        # caps filter
-        if gcfg["filters"].get("caps_filter", True):
-            if len(content) > 10 and content.isupper():
-                try:
-                    await message.delete()
-                except:
-                    pass
-                log_action(message.guild, f"🧢 Caps message deleted from {message.author}")
-                try:
-                    await message.author.send("🧢 Please avoid excessive caps.")
-                except:
-                    pass
-                return
+        # Always process commands first
+        await bot.process_commands(message)
 
-        # anti-spam
-        if gcfg["filters"].get("anti_spam", True):
-            nowt = time.time()
-            lst = user_message_times.get(message.author.id, [])
-            lst = [t for t in lst if nowt - t < 5]
-            lst.append(nowt)
-            user_message_times[message.author.id] = lst
-            if len(lst) > 5:
-                try:
-                    await message.delete()
-                except:
-                    pass
-                log_action(message.guild, f"🚷 Spam: {message.author}")
-                try:
-                    await message.author.send("⛔ Slow down — you're sending messages too quickly.")
-                except:
-                    pass
-                return
+        if not message.guild:
+            # allow XP in guild-only; skip DMs for auto-mod
+            return
 
-        # XP
-        try:
-            xp_add_message(message.author)
-        except Exception:
-            pass
+        event_router.submit(message)
 
     except Exception:
         print("on_message error:", traceback.format_exc())
@@ -422,34 +2900,113 @@ async def on_message(message: discord.Message):
 @app_commands.checks.has_permissions(administrator=True)
 async def setwelcome(interaction: discord.Interaction, channel: discord.TextChannel):
     gcfg = guild_config(interaction.guild.id)
-    gcfg["welcome_channel"] = str(channel.id)
-    save_json(CONFIG_FILE, config)
+    gcfg.welcome_channel = channel.id
+    save_config(interaction.guild.id)
     await interaction.response.send_message(f"✅ Welcome channel set to {channel.mention}", ephemeral=True)
 
 @bot.tree.command(name="setgoodbye", description="Set goodbye channel")
 @app_commands.checks.has_permissions(administrator=True)
 async def setgoodbye(interaction: discord.Interaction, channel: discord.TextChannel):
     gcfg = guild_config(interaction.guild.id)
-    gcfg["goodbye_channel"] = str(channel.id)
-    save_json(CONFIG_FILE, config)
+    gcfg.goodbye_channel = channel.id
+    save_config(interaction.guild.id)
     await interaction.response.send_message(f"✅ Goodbye channel set to {channel.mention}", ephemeral=True)
 
 @bot.tree.command(name="setlog", description="Set log channel")
 @app_commands.checks.has_permissions(administrator=True)
 async def setlog(interaction: discord.Interaction, channel: discord.TextChannel):
     gcfg = guild_config(interaction.guild.id)
-    gcfg["log_channel"] = str(channel.id)
-    save_json(CONFIG_FILE, config)
+    gcfg.log_channel = channel.id
+    save_config(interaction.guild.id)
     await interaction.response.send_message(f"✅ Log channel set to {channel.mention}", ephemeral=True)
 
 @bot.tree.command(name="setwelcomedm", description="Set custom welcome DM (use {user} and {server})")
 @app_commands.checks.has_permissions(administrator=True)
 async def setwelcomedm(interaction: discord.Interaction, *, message: str):
     gcfg = guild_config(interaction.guild.id)
-    gcfg["welcome_dm"] = message
-    save_json(CONFIG_FILE, config)
+    gcfg.welcome_dm = message
+    save_config(interaction.guild.id)
     await interaction.response.send_message("✅ Welcome DM updated.", ephemeral=True)
 
+@bot.tree.command(name="setspam", description="Set the anti-spam threshold (messages per seconds)")
+@app_commands.checks.has_permissions(administrator=True)
+@app_commands.describe(messages="Max messages allowed in the window", seconds="Window length in seconds")
+async def setspam(interaction: discord.Interaction, messages: app_commands.Range[int, 1, 50], seconds: app_commands.Range[int, 1, SPAM_IDLE_EVICT]):
+    gcfg = guild_config(interaction.guild.id)
+    gcfg.spam_messages = messages
+    gcfg.spam_window = seconds
+    save_config(interaction.guild.id)
+    await interaction.response.send_message(f"✅ Anti-spam: more than {messages} messages in {seconds}s is spam.", ephemeral=True)
+
+@bot.tree.command(name="setdupes", description="Configure duplicate-message raid detection")
+@app_commands.checks.has_permissions(administrator=True)
+@app_commands.describe(authors="Distinct accounts allowed to post the same message", seconds="Window length in seconds",
+                       enabled="Turn the check on or off")
+async def setdupes(interaction: discord.Interaction, authors: app_commands.Range[int, 1, 100] = DUP_MAX_AUTHORS,
+                   seconds: app_commands.Range[int, 5, 3600] = DUP_WINDOW, enabled: bool = True):
+    gcfg = guild_config(interaction.guild.id)
+    gcfg.dup_filter = enabled
+    gcfg.dup_authors = authors
+    gcfg.dup_window = seconds
+    save_config(interaction.guild.id)
+    if enabled:
+        text = f"✅ Raid detection: the same message from more than {authors} accounts within {seconds}s is removed."
+    else:
+        text = "✅ Duplicate-message raid detection disabled."
+    await interaction.response.send_message(text, ephemeral=True)
+
+@bot.tree.command(name="banword", description="Add a word or phrase to the automod banned list")
+@app_commands.checks.has_permissions(manage_guild=True)
+async def banword(interaction: discord.Interaction, word: str):
+    gcfg = guild_config(interaction.guild.id)
+    words = gcfg.banned_words
+    word = word.strip().lower()[:MAX_BANNED_WORD_LEN]
+    if not word or word in words:
+        await interaction.response.send_message("That word is already banned.", ephemeral=True)
+        return
+    words.append(word)
+    save_config(interaction.guild.id)
+    await interaction.response.send_message(f"✅ Banned `{word}` ({len(words)} banned words).", ephemeral=True)
+
+@bot.tree.command(name="unbanword", description="Remove a word or phrase from the automod banned list")
+@app_commands.checks.has_permissions(manage_guild=True)
+async def unbanword(interaction: discord.Interaction, word: str):
+    gcfg = guild_config(interaction.guild.id)
+    words = gcfg.banned_words
+    word = word.strip().lower()
+    if word not in words:
+        await interaction.response.send_message("That word is not on the banned list.", ephemeral=True)
+        return
+    words.remove(word)
+    save_config(interaction.guild.id)
+    await interaction.response.send_message(f"✅ Removed `{word}` from the banned list.", ephemeral=True)
+
+@bot.tree.command(name="bannedwords", description="List the automod banned words")
+@app_commands.checks.has_permissions(manage_guild=True)
+async def bannedwords(interaction: discord.Interaction):
+    words = guild_config(interaction.guild.id).banned_words
+    if not words:
+        await interaction.response.send_message("No banned words set.", ephemeral=True)
+        return
+    text = ", ".join(f"`{w}`" for w in words)
+    await interaction.response.send_message(f"🤐 {len(words)} banned words: {text}"[:2000], ephemeral=True)
+
+@bot.tree.command(name="setjoinflood", description="Configure join-burst welcomes and the raid alarm")
+@app_commands.checks.has_permissions(administrator=True)
+@app_commands.describe(burst="Joins per window that switch to combined welcomes", raid="Joins per window that count as a raid",
+                       window="Window length in seconds", lockdown="Raise verification level automatically on a raid")
+async def setjoinflood(interaction: discord.Interaction, burst: app_commands.Range[int, 2, 1000], raid: app_commands.Range[int, 2, 1000],
+                       window: app_commands.Range[int, 1, 600] = 10, lockdown: bool = False):
+    gcfg = guild_config(interaction.guild.id)
+    gcfg.join_burst_threshold = burst
+    gcfg.join_raid_threshold = raid
+    gcfg.join_window = window
+    gcfg.raid_lockdown = lockdown
+    save_config(interaction.guild.id)
+    await interaction.response.send_message(
+        f"✅ Combined welcomes from {burst} joins/{window}s; raid alarm at {raid} joins/{window}s (lockdown {'on' if lockdown else 'off'}).",
+        ephemeral=True)
+
 # Moderation commands
 @bot.tree.command(name="kick", description="Kick a member")
 @app_commands.checks.has_permissions(kick_members=True)
@@ -457,12 +3014,10 @@ async def setwelcomedm(interaction: discord.Interaction, *, message: str):
 async def slash_kick(interaction: discord.Interaction, member: discord.Member, reason: str = "No reason provided"):
     try:
         await member.kick(reason=reason)
+        infractions.add(interaction.guild.id, member.id, "kick", interaction.user, reason)
         await interaction.response.send_message(f"👢 {member.mention} kicked. Reason: {reason}")
-        log_action(interaction.guild, f"👢 Kick: {member} by {interaction.user} — {reason}")
-        try:
-            await member.send(f"👢 You were kicked from {interaction.guild.name}. Reason: {reason}")
-        except:
-            pass
+        log_action(interaction.guild, f"👢 Kick: {member} by {interaction.user} — {reason}", LOG_HIGH)
+        send_dm(member, f"👢 You were kicked from {interaction.guild.name}. Reason: {reason}")
     except Exception:
         await interaction.response.send_message("❌ Failed to kick (permissions?).", ephemeral=True)
 
@@ -472,39 +3027,284 @@ async def slash_kick(interaction: discord.Interaction, member: discord.Member, r
 async def slash_ban(interaction: discord.Interaction, member: discord.Member, reason: str = "No reason provided"):
     try:
         await member.ban(reason=reason)
+        infractions.add(interaction.guild.id, member.id, "ban", interaction.user, reason)
         await interaction.response.send_message(f"⛔ {member.mention} banned. Reason: {reason}")
-        log_action(interaction.guild, f"⛔ Ban: {member} by {interaction.user} — {reason}")
-        try:
-            await member.send(f"⛔ You were banned from {interaction.guild.name}. Reason: {reason}")
-        except:
-            pass
+        log_action(interaction.guild, f"⛔ Ban: {member} by {interaction.user} — {reason}", LOG_HIGH)
+        send_dm(member, f"⛔ You were banned from {interaction.guild.name}. Reason: {reason}")
     except Exception:
         await interaction.response.send_message("❌ Failed to ban (permissions?).", ephemeral=True)
 
-@bot.tree.command(name="unban", description="Unban a user by name#discriminator or ID")
+@bot.tree.command(name="unban", description="Unban a user by username, display name or ID")
 @app_commands.checks.has_permissions(ban_members=True)
-@app_commands.describe(user="username#discriminator or user id")
+@app_commands.describe(user="username, global display name or user id")
 async def slash_unban(interaction: discord.Interaction, user: str):
+    guild = interaction.guild
+    user = user.strip()
+    if user.isdigit():
+        try:
+            await guild.unban(discord.Object(id=int(user)))
+            await interaction.response.send_message(f"✅ Unbanned id {user}", ephemeral=True)
+        except discord.NotFound:
+            await interaction.response.send_message("❌ User not found in bans.", ephemeral=True)
+        except Exception:
+            await interaction.response.send_message("❌ Failed to unban.", ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True)
     try:
-        if user.isdigit():
-            try:
-                await interaction.guild.unban(discord.Object(id=int(user)))
-                await interaction.response.send_message(f"✅ Unbanned id {user}", ephemeral=True)
-                return
-            except:
-                pass
-        if "#" in user:
-            name, discr = user.split("#", 1)
-            bans = await interaction.guild.bans()
-            for entry in bans:
-                u = entry.user
-                if u.name == name and u.discriminator == discr:
-                    await interaction.guild.unban(u)
-                    await interaction.response.send_message(f"✅ Unbanned {u}", ephemeral=True)
-                    return
-        await interaction.response.send_message("❌ User not found in bans.", ephemeral=True)
+        entry = await ban_index.ensure(guild)
+        matches = ban_index.find(guild.id, user)
+        if not matches:
+            await interaction.followup.send("❌ User not found in bans.", ephemeral=True)
+            return
+        if len(matches) > 1:
+            listed = "\n".join(f"• {entry.label(uid)} — `{uid}`" for uid in matches[:10])
+            await interaction.followup.send(f"⚠️ Several banned users match **{user}**; unban by id:\n{listed}", ephemeral=True)
+            return
+        uid = matches[0]
+        label = entry.label(uid)
+        await guild.unban(discord.Object(id=uid))
+        await interaction.followup.send(f"✅ Unbanned {label}", ephemeral=True)
+        log_action(guild, f"✅ Unban: {label} by {interaction.user}")
     except Exception:
-        await interaction.response.send_message("❌ Failed to unban.", ephemeral=True)
+        await interaction.followup.send("❌ Failed to unban.", ephemeral=True)
+
+@slash_unban.autocomplete("user")
+async def unban_autocomplete(interaction: discord.Interaction, current: str):
+    # answers from whatever is indexed so far; the first call starts the build
+    entry = ban_index.start_build(interaction.guild)
+    return [app_commands.Choice(name=entry.label(uid)[:100], value=str(uid))
+            for uid in ban_index.search(interaction.guild.id, current)]
+
+@bot.tree.command(name="unban_bulk", description="Unban several users at once")
+@app_commands.checks.has_permissions(ban_members=True)
+@app_commands.describe(users="User ids or usernames, separated by spaces or commas", reason="Reason")
+async def slash_unban_bulk(interaction: discord.Interaction, users: str, reason: str = "Bulk unban"):
+    guild = interaction.guild
+    await interaction.response.defer(ephemeral=True)
+    queries = [q for q in re.split(r"[\s,]+", users) if q]
+    if any(not q.isdigit() for q in queries):
+        try:
+            await ban_index.ensure(guild)
+        except Exception:
+            await interaction.followup.send("❌ Failed to fetch the ban list.", ephemeral=True)
+            return
+    targets, unknown, ambiguous = [], [], []
+    for q in queries:
+        matches = [int(q)] if q.isdigit() else ban_index.find(guild.id, q)
+        if not matches:
+            unknown.append(q)
+        elif len(matches) > 1:
+            ambiguous.append(q)
+        elif matches[0] not in targets:
+            targets.append(matches[0])
+    sem = asyncio.Semaphore(UNBAN_CONCURRENCY)
+    done, failed = [], []
+
+    async def unban_one(uid):
+        async with sem:
+            try:
+                await guild.unban(discord.Object(id=uid), reason=f"{reason} (by {interaction.user})")
+                done.append(uid)
+            except discord.NotFound:
+                unknown.append(str(uid))
+            except Exception:
+                failed.append(str(uid))
+
+    await asyncio.gather(*(unban_one(uid) for uid in targets))
+    lines = [f"✅ Unbanned {len(done)} user(s)."]
+    if unknown:
+        lines.append(f"❓ Not banned/not found: {', '.join(unknown)[:500]}")
+    if ambiguous:
+        lines.append(f"⚠️ Ambiguous (use ids): {', '.join(ambiguous)[:500]}")
+    if failed:
+        lines.append(f"❌ Failed: {', '.join(failed)[:500]}")
+    await interaction.followup.send("\n".join(lines), ephemeral=True)
+    if done:
+        log_action(guild, f"✅ Bulk unban: {len(done)} user(s) by {interaction.user} — {reason}", LOG_HIGH)
+
+# Raid cleanup: /purge and /massban
+PURGE_SCAN_MAX = 2000
+PURGE_CHUNK = 100               # Discord's bulk delete limit
+PURGE_BULK_MAX_AGE = 14 * 86400 - 600  # bulk delete refuses messages older than 14 days; keep a margin
+PURGE_OLD_DELAY = 1.0           # seconds between single deletes of old messages
+MASSBAN_CHUNK = 200             # Guild.bulk_ban limit
+MASSBAN_CONCURRENCY = 5
+PROGRESS_INTERVAL = 2.0         # seconds between progress edits
+
+class ConfirmView(View):
+    def __init__(self, author_id, timeout=60):
+        super().__init__(timeout=timeout)
+        self.author_id = author_id
+        self.confirmed = None
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        return interaction.user.id == self.author_id
+
+    @discord.ui.button(label="Confirm", style=discord.ButtonStyle.red)
+    async def confirm(self, interaction: discord.Interaction, button: Button):
+        self.confirmed = True
+        await interaction.response.edit_message(view=None)
+        self.stop()
+
+    @discord.ui.button(label="Cancel", style=discord.ButtonStyle.gray)
+    async def cancel(self, interaction: discord.Interaction, button: Button):
+        self.confirmed = False
+        await interaction.response.edit_message(content="Cancelled.", view=None)
+        self.stop()
+
+class Progress:
+    # edits one ephemeral followup at most every PROGRESS_INTERVAL seconds
+    def __init__(self, interaction, label):
+        self.interaction = interaction
+        self.label = label
+        self.last = 0.0
+
+    async def update(self, done, total, force=False):
+        now = time.monotonic()
+        if not force and now - self.last < PROGRESS_INTERVAL:
+            return
+        self.last = now
+        try:
+            await self.interaction.edit_original_response(content=f"⏳ {self.label}: {done}/{total}")
+        except discord.HTTPException:
+            pass
+
+@bot.tree.command(name="purge", description="Bulk delete recent messages in this channel")
+@app_commands.checks.has_permissions(manage_messages=True)
+@app_commands.describe(amount="How many recent messages to scan", user="Only messages from this member",
+                       pattern="Only messages matching this regex", within="Only messages newer than this (10m, 2h, 1d)",
+                       bots="Only messages from bots")
+async def slash_purge(interaction: discord.Interaction, amount: app_commands.Range[int, 1, PURGE_SCAN_MAX],
+                      user: discord.Member = None, pattern: str = None, within: str = None, bots: bool = False):
+    channel = interaction.channel
+    regex = None
+    if pattern:
+        try:
+            regex = re.compile(pattern[:200], re.IGNORECASE)
+        except re.error as e:
+            await interaction.response.send_message(f"❌ Invalid regex: {e}", ephemeral=True)
+            return
+    after = None
+    if within:
+        sec = parse_duration(within)
+        if sec is None:
+            await interaction.response.send_message("❌ Invalid duration format.", ephemeral=True)
+            return
+        after = discord.utils.utcnow() - datetime.timedelta(seconds=sec)
+    await interaction.response.defer(ephemeral=True, thinking=True)
+
+    def wanted(m):
+        if m.pinned:
+            return False
+        if user is not None and m.author.id != user.id:
+            return False
+        if bots and not m.author.bot:
+            return False
+        return regex is None or regex.search(m.content or "") is not None
+
+    bulk_cutoff = discord.utils.utcnow() - datetime.timedelta(seconds=PURGE_BULK_MAX_AGE)
+    recent, old = [], []
+    async for m in channel.history(limit=amount, after=after, oldest_first=False):
+        if wanted(m):
+            (recent if m.created_at > bulk_cutoff else old).append(m)
+    total = len(recent) + len(old)
+    progress = Progress(interaction, "Deleting")
+    deleted = failed = 0
+    for i in range(0, len(recent), PURGE_CHUNK):
+        chunk = recent[i:i + PURGE_CHUNK]
+        try:
+            await channel.delete_messages(chunk, reason=f"Purge by {interaction.user}")
+            deleted += len(chunk)
+        except discord.HTTPException:
+            failed += len(chunk)
+        await progress.update(deleted, total)
+    # older than 14 days: one request per message, paced
+    for m in old:
+        try:
+            await m.delete()
+            deleted += 1
+        except discord.NotFound:
+            pass
+        except discord.HTTPException:
+            failed += 1
+        await progress.update(deleted, total)
+        await asyncio.sleep(PURGE_OLD_DELAY)
+    text = f"🧹 Deleted {deleted} message(s)" + (f", {failed} failed" if failed else "") + "."
+    await interaction.edit_original_response(content=text)
+    if deleted:
+        log_action(interaction.guild, f"🧹 Purge: {deleted} message(s) in {channel.mention} by {interaction.user}", LOG_HIGH)
+
+@bot.tree.command(name="massban", description="Ban many users at once: by ids or by recent join time")
+@app_commands.checks.has_permissions(ban_members=True)
+@app_commands.describe(ids="User ids separated by spaces or commas", joined_minutes="Members who joined in the last N minutes",
+                       delete_days="Days of their messages to delete (0-7)", reason="Reason")
+async def slash_massban(interaction: discord.Interaction, ids: str = None,
+                        joined_minutes: app_commands.Range[int, 1, 1440] = None,
+                        delete_days: app_commands.Range[int, 0, 7] = 1, reason: str = "Mass ban"):
+    guild = interaction.guild
+    targets = {}
+    for part in re.split(r"[\s,]+", ids or ""):
+        if part.isdigit():
+            targets[int(part)] = guild.get_member(int(part)) or discord.Object(id=int(part))
+    if joined_minutes:
+        since = discord.utils.utcnow() - datetime.timedelta(minutes=joined_minutes)
+        for m in guild.members:
+            if m.joined_at and m.joined_at >= since and not m.bot:
+                targets[m.id] = m
+    # never the invoker, the owner, ourselves, or anyone we cannot outrank
+    me = guild.me
+    for uid, t in list(targets.items()):
+        if uid in (interaction.user.id, guild.owner_id, me.id) or (
+                isinstance(t, discord.Member) and t.top_role >= me.top_role):
+            del targets[uid]
+    if not targets:
+        await interaction.response.send_message("❌ Nobody to ban.", ephemeral=True)
+        return
+    view = ConfirmView(interaction.user.id)
+    await interaction.response.send_message(f"⚠️ Ban **{len(targets)}** user(s)? Reason: {reason}", view=view, ephemeral=True)
+    await view.wait()
+    if not view.confirmed:
+        return
+
+    users = list(targets.values())
+    progress = Progress(interaction, "Banning")
+    banned, failed = [], []
+    full_reason = f"{reason} (mass ban by {interaction.user})"
+    sem = asyncio.Semaphore(MASSBAN_CONCURRENCY)
+
+    async def ban_one(u):
+        async with sem:
+            try:
+                await guild.ban(u, reason=full_reason, delete_message_seconds=delete_days * 86400)
+                banned.append(u.id)
+            except discord.HTTPException:
+                failed.append(u.id)
+            await progress.update(len(banned) + len(failed), len(users))
+
+    async def ban_chunk(chunk):
+        async with sem:
+            try:
+                result = await guild.bulk_ban(chunk, reason=full_reason, delete_message_seconds=delete_days * 86400)
+                banned.extend(o.id for o in result.banned)
+                failed.extend(o.id for o in result.failed)
+            except discord.Forbidden:
+                # bulk ban also needs Manage Server; fall back to single bans
+                fallback.extend(chunk)
+            except discord.HTTPException:
+                failed.extend(u.id for u in chunk)
+            await progress.update(len(banned) + len(failed), len(users))
+
+    fallback = []
+    if hasattr(guild, "bulk_ban"):  # discord.py 2.4+
+        await asyncio.gather(*(ban_chunk(users[i:i + MASSBAN_CHUNK]) for i in range(0, len(users), MASSBAN_CHUNK)))
+    else:
+        fallback = users
+    await asyncio.gather(*(ban_one(u) for u in fallback))
+    for uid in banned:
+        infractions.add(guild.id, uid, "ban", interaction.user, reason, mass=True)
+    text = f"⛔ Banned {len(banned)} user(s)" + (f", {len(failed)} failed" if failed else "") + "."
+    await interaction.edit_original_response(content=text, view=None)
+    log_action(guild, f"⛔ Mass ban: {len(banned)} user(s) by {interaction.user} — {reason}", LOG_HIGH)
 
 # Timeout/parsing
 def parse_duration(duration: str):
@@ -528,23 +3328,15 @@ async def slash_timeout(interaction: discord.Interaction, member: discord.Member
         until = discord.utils.utcnow() + datetime.timedelta(seconds=sec)
         await member.timeout(until, reason=reason)
         await interaction.response.send_message(f"⏳ {member.mention} timed out for {duration}. Reason: {reason}")
-        log_action(interaction.guild, f"⏳ Timeout: {member} for {duration} by {interaction.user} — {reason}")
+        log_action(interaction.guild, f"⏳ Timeout: {member} for {duration} by {interaction.user} — {reason}", LOG_HIGH)
         # record timeout
-        tdata = load_timeouts()
-        uid = str(member.id)
-        rec = {"moderator": str(interaction.user), "duration": duration, "reason": reason, "timestamp": now_iso()}
-        tdata.setdefault(uid, []).append(rec)
-        save_timeouts(tdata)
+        gid = interaction.guild.id
+        infractions.add(gid, member.id, "timeout", interaction.user, reason, duration=duration)
         # auto-warn after 3 timeouts
-        if len(tdata.get(uid, [])) >= 3:
-            wdata = load_warnings()
-            wdata.setdefault(uid, []).append({"moderator":"Auto-Mod","reason":"3+ timeouts","time":now_iso()})
-            save_warnings(wdata)
-            log_action(interaction.guild, f"⚠️ Auto-warn: {member} after 3 timeouts.")
-            try:
-                await member.send("⚠️ You received an automatic warning for repeated timeouts.")
-            except:
-                pass
+        if infractions.recent_timeouts(gid, member.id) >= AUTO_WARN_TIMEOUTS:
+            infractions.add(gid, member.id, "warn", "Auto-Mod", f"{AUTO_WARN_TIMEOUTS}+ timeouts")
+            log_action(interaction.guild, f"⚠️ Auto-warn: {member} after {AUTO_WARN_TIMEOUTS} timeouts.", LOG_HIGH)
+            send_dm(member, "⚠️ You received an automatic warning for repeated timeouts.")
             await check_auto_ban(interaction.guild, member)
     except discord.Forbidden:
         await interaction.response.send_message("⚠️ Missing permission to timeout that member.", ephemeral=True)
@@ -564,77 +3356,106 @@ async def slash_untimeout(interaction: discord.Interaction, member: discord.Memb
 @bot.tree.command(name="timeouts", description="Show timeout history for a user")
 @app_commands.checks.has_permissions(moderate_members=True)
 async def slash_timeouts(interaction: discord.Interaction, member: discord.Member):
-    tdata = load_timeouts()
-    uid = str(member.id)
-    items = tdata.get(uid, [])
+    items = infractions.history(interaction.guild.id, member.id, "timeout")
     if not items:
         await interaction.response.send_message(f"No timeouts for {member.mention}", ephemeral=True)
         return
     embed = discord.Embed(title=f"⏳ Timeouts for {member}", color=discord.Color.orange())
     for i, rec in enumerate(items[-10:], start=1):
-        embed.add_field(name=f"#{i}", value=f"{rec['duration']} — {rec['reason']} by {rec['moderator']}\n{rec['timestamp']}", inline=False)
+        embed.add_field(name=f"#{i}", value=f"{rec.get('duration', '?')} — {rec['reason']} by {rec['moderator']}\n{rec['time']}", inline=False)
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
+# Temporary bans & roles (lifted by the scheduler)
+@bot.tree.command(name="tempban", description="Ban a member for a limited time (e.g., 1h, 7d)")
+@app_commands.checks.has_permissions(ban_members=True)
+@app_commands.describe(member="Member to ban", duration="10m,1h,1d", reason="Reason")
+async def slash_tempban(interaction: discord.Interaction, member: discord.Member, duration: str, reason: str = "No reason provided"):
+    sec = parse_duration(duration)
+    if sec is None or sec <= 0:
+        await interaction.response.send_message("❌ Invalid duration format.", ephemeral=True)
+        return
+    try:
+        await member.ban(reason=f"{reason} (temporary: {duration})")
+    except Exception:
+        await interaction.response.send_message("❌ Failed to ban (permissions?).", ephemeral=True)
+        return
+    scheduler.add("unban", time.time() + sec, interaction.guild.id, key=member.id, user=member.id)
+    infractions.add(interaction.guild.id, member.id, "ban", interaction.user, reason, duration=duration)
+    await interaction.response.send_message(f"⛔ {member.mention} banned for {duration}. Reason: {reason}")
+    log_action(interaction.guild, f"⛔ Temp-ban: {member} for {duration} by {interaction.user} — {reason}", LOG_HIGH)
+    send_dm(member, f"⛔ You were banned from {interaction.guild.name} for {duration}. Reason: {reason}")
+
+@bot.tree.command(name="temprole", description="Give a member a role for a limited time")
+@app_commands.checks.has_permissions(manage_roles=True)
+@app_commands.describe(member="Member", role="Role to give", duration="10m,1h,1d")
+async def slash_temprole(interaction: discord.Interaction, member: discord.Member, role: discord.Role, duration: str):
+    sec = parse_duration(duration)
+    if sec is None or sec <= 0:
+        await interaction.response.send_message("❌ Invalid duration format.", ephemeral=True)
+        return
+    try:
+        await member.add_roles(role, reason=f"Temporary role ({duration}) by {interaction.user}")
+    except Exception:
+        await interaction.response.send_message("❌ Failed to add role (permissions/hierarchy?).", ephemeral=True)
+        return
+    scheduler.add("remove_role", time.time() + sec, interaction.guild.id, key=f"{member.id}:{role.id}", user=member.id, role=role.id)
+    await interaction.response.send_message(f"✅ Gave {role.mention} to {member.mention} for {duration}", ephemeral=True)
+    log_action(interaction.guild, f"🎭 Temp-role: {role.name} to {member} for {duration} by {interaction.user}")
+
 # Warning system
 @bot.tree.command(name="warn", description="Warn a member")
 @app_commands.checks.has_permissions(manage_messages=True)
 @app_commands.describe(member="Member to warn", reason="Reason")
 async def slash_warn(interaction: discord.Interaction, member: discord.Member, reason: str = "No reason provided"):
-    w = load_warnings()
-    uid = str(member.id)
-    rec = {"moderator": str(interaction.user), "reason": reason, "time": now_iso()}
-    w.setdefault(uid, []).append(rec)
-    save_warnings(w)
+    infractions.add(interaction.guild.id, member.id, "warn", interaction.user, reason)
     await interaction.response.send_message(f"⚠️ Warned {member.mention}. Reason: {reason}")
-    log_action(interaction.guild, f"⚠️ Warn: {member} by {interaction.user} — {reason}")
-    try:
-        await member.send(f"⚠️ You were warned in {interaction.guild.name}. Reason: {reason}")
-    except:
-        pass
+    log_action(interaction.guild, f"⚠️ Warn: {member} by {interaction.user} — {reason}", LOG_HIGH)
+    send_dm(member, f"⚠️ You were warned in {interaction.guild.name}. Reason: {reason}")
     await check_auto_ban(interaction.guild, member)
 
 @bot.tree.command(name="warnings", description="Show warnings for a user")
 @app_commands.checks.has_permissions(manage_messages=True)
 async def slash_warnings(interaction: discord.Interaction, member: discord.Member):
-    w = load_warnings()
-    uid = str(member.id)
-    items = w.get(uid, [])
+    items = infractions.history(interaction.guild.id, member.id, "warn")
     if not items:
         await interaction.response.send_message(f"{member.mention} has no warnings.", ephemeral=True)
         return
+    active = infractions.active_warnings(interaction.guild.id, member.id)
     embed = discord.Embed(title=f"⚠️ Warnings for {member}", color=discord.Color.orange())
+    embed.set_footer(text=f"{active} active (count toward auto-ban at {AUTO_BAN_WARNINGS})")
     for i, rec in enumerate(items[-10:], start=1):
-        embed.add_field(name=f"#{i}", value=f"{rec['reason']} — {rec['moderator']}\n{rec['time']}", inline=False)
+        expired = " (expired)" if infractions.is_expired(rec) else ""
+        embed.add_field(name=f"#{i}{expired}", value=f"{rec['reason']} — {rec['moderator']}\n{rec['time']}", inline=False)
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 @bot.tree.command(name="clearwarns", description="Clear all warnings for a user")
 @app_commands.checks.has_permissions(manage_messages=True)
 async def slash_clearwarns(interaction: discord.Interaction, member: discord.Member):
-    w = load_warnings()
-    uid = str(member.id)
-    if uid in w:
-        del w[uid]
-        save_warnings(w)
+    if infractions.history(interaction.guild.id, member.id, "warn"):
+        infractions.add(interaction.guild.id, member.id, "clear", interaction.user)
         await interaction.response.send_message(f"✅ Cleared warnings for {member.mention}", ephemeral=True)
         log_action(interaction.guild, f"🧹 Cleared warnings for {member} by {interaction.user}")
     else:
         await interaction.response.send_message("That user has no warnings.", ephemeral=True)
 
 # Infractions
-@bot.tree.command(name="infractions", description="View all warnings and timeouts for a user")
+@bot.tree.command(name="infractions", description="View all warnings, timeouts, kicks and bans for a user")
 @app_commands.checks.has_permissions(moderate_members=True)
 async def slash_infractions(interaction: discord.Interaction, member: discord.Member):
-    w = load_warnings(); t = load_timeouts()
-    uid = str(member.id)
-    warns = w.get(uid, []); topts = t.get(uid, [])
-    total = len(warns) + len(topts)
+    gid = interaction.guild.id
+    records = infractions.history(gid, member.id) + infractions.history(0, member.id)
+    warns = [r for r in records if r["type"] == "warn"]
+    topts = [r for r in records if r["type"] == "timeout"]
+    removals = [r for r in records if r["type"] in ("kick", "ban")]
+    total = len(warns) + len(topts) + len(removals)
     if total == 0:
         await interaction.response.send_message(f"{member.mention} has a clean record!", ephemeral=True)
         return
     embed = discord.Embed(title=f"📜 Infractions for {member}", color=discord.Color.red() if total>3 else discord.Color.orange())
     embed.set_thumbnail(url=member.display_avatar.url)
-    embed.add_field(name="Warnings", value=str(len(warns)), inline=True)
+    embed.add_field(name="Warnings", value=f"{len(warns)} ({infractions.active_warnings(gid, member.id)} active)", inline=True)
     embed.add_field(name="Timeouts", value=str(len(topts)), inline=True)
+    embed.add_field(name="Kicks/Bans", value=str(len(removals)), inline=True)
     if warns:
         text = ""
         for i, rec in enumerate(warns[-5:], start=1):
@@ -643,8 +3464,15 @@ async def slash_infractions(interaction: discord.Interaction, member: discord.Me
     if topts:
         text = ""
         for i, rec in enumerate(topts[-5:], start=1):
-            text += f"#{i} {rec['duration']} {rec['reason']} — {rec['moderator']} ({rec['timestamp']})\n"
+            text += f"#{i} {rec.get('duration', '?')} {rec['reason']} — {rec['moderator']} ({rec['time']})\n"
         embed.add_field(name="Recent Timeouts", value=text[:1024], inline=False)
+    if removals:
+        text = ""
+        for rec in removals[-5:]:
+            text += f"{rec['type']} {rec['reason']} — {rec['moderator']} ({rec['time']})\n"
+        embed.add_field(name="Kicks & Bans", value=text[:1024], inline=False)
+    if any(r["guild"] == 0 for r in records):
+        embed.set_footer(text="Includes entries from before infractions were tracked per server")
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 # Tickets & reaction panels (admin)
@@ -659,18 +3487,27 @@ async def ticket_panel(interaction: discord.Interaction):
 @app_commands.checks.has_permissions(manage_guild=True)
 async def ticket_category(interaction: discord.Interaction, category: discord.CategoryChannel):
     gcfg = guild_config(interaction.guild.id)
-    gcfg["ticket_category"] = str(category.id)
-    save_json(CONFIG_FILE, config)
+    gcfg.ticket_category = category.id
+    save_config(interaction.guild.id)
     await interaction.response.send_message(f"✅ Ticket category set to {category.name}", ephemeral=True)
 
+@bot.tree.command(name="ticket_transcript", description="Set the ticket transcript format")
+@app_commands.checks.has_permissions(manage_guild=True)
+@app_commands.choices(fmt=[app_commands.Choice(name=f, value=f) for f in TRANSCRIPT_FORMATS])
+async def ticket_transcript(interaction: discord.Interaction, fmt: app_commands.Choice[str]):
+    gcfg = guild_config(interaction.guild.id)
+    gcfg.transcript_format = fmt.value
+    save_config(interaction.guild.id)
+    await interaction.response.send_message(f"✅ Ticket transcripts will be saved as {fmt.value}", ephemeral=True)
+
 @bot.tree.command(name="reaction_panel", description="Create a reaction/ button role panel")
 @app_commands.checks.has_permissions(manage_roles=True)
 @app_commands.describe(panel_type="button or reaction")
 async def reaction_panel(interaction: discord.Interaction, panel_type: str = "button", *, text: str = "React to get roles"):
     embed = discord.Embed(title="Reaction Roles", description=text, color=discord.Color.blurple())
     msg = await interaction.channel.send(embed=embed)
-    reaction_panels[str(msg.id)] = {"guild": str(interaction.guild.id), "type": panel_type, "roles": {}}
-    save_reaction_panels()
+    reaction_panels[str(msg.id)] = {"guild": str(interaction.guild.id), "channel": str(interaction.channel.id), "type": panel_type, "roles": {}}
+    save_reaction_panels(msg.id)
     if panel_type == "button":
         try:
             await msg.edit(view=ReactionRoleView(msg.id))
@@ -685,30 +3522,18 @@ async def add_reaction_role(interaction: discord.Interaction, message_id: str, e
     if not panel:
         await interaction.response.send_message("Panel not found.", ephemeral=True); return
     panel["roles"][emoji] = str(role.id)
-    save_reaction_panels()
-    if panel.get("type") == "reaction":
-        try:
-            # attempt to find message
-            for ch in interaction.guild.text_channels:
-                try:
-                    m = await ch.fetch_message(int(message_id))
-                    await m.add_reaction(emoji)
-                    break
-                except:
-                    continue
-        except:
-            pass
-    else:
-        try:
-            for ch in interaction.guild.text_channels:
-                try:
-                    m = await ch.fetch_message(int(message_id))
-                    await m.edit(view=ReactionRoleView(message_id))
-                    break
-                except:
-                    continue
-        except:
-            pass
+    save_reaction_panels(message_id)
+    try:
+        m = await find_panel_message(interaction.guild, message_id, panel)
+        if m is not None:
+            if panel.get("type") == "reaction":
+                await m.add_reaction(emoji)
+            else:
+                view = ReactionRoleView(message_id)
+                await m.edit(view=view)
+                bot.add_view(view, message_id=int(message_id))
+    except:
+        pass
     await interaction.response.send_message(f"✅ Added {emoji} -> {role.name} to panel {message_id}", ephemeral=True)
 
 # Premium toggle + example
@@ -716,18 +3541,78 @@ async def add_reaction_role(interaction: discord.Interaction, message_id: str, e
 @app_commands.checks.has_permissions(administrator=True)
 async def premium_toggle(interaction: discord.Interaction, enable: bool):
     gcfg = guild_config(interaction.guild.id)
-    gcfg["premium"] = bool(enable)
-    save_json(CONFIG_FILE, config)
+    gcfg.premium = bool(enable)
+    save_config(interaction.guild.id)
     await interaction.response.send_message(f"Premium utilities {'enabled' if enable else 'disabled'} for this server.", ephemeral=True)
 
 @bot.tree.command(name="premium_info", description="(Premium) Show upgraded utilities - example")
 async def premium_info(interaction: discord.Interaction):
     gcfg = guild_config(interaction.guild.id)
-    if not gcfg.get("premium"):
+    if not gcfg.premium:
         await interaction.response.send_message("This server does not have premium utilities enabled. Ask an admin to run `/premium true`", ephemeral=True)
         return
     await interaction.response.send_message("✨ Premium utilities active: advanced logs, priority ticket handling, extra automod rules.", ephemeral=True)
 
+# XP rank & leaderboard
+LEADERBOARD_PAGE_SIZE = 10
+
+def leaderboard_embed(guild: discord.Guild, page: int):
+    total = xp_ranks.size(guild.id)
+    pages = max(1, -(-total // LEADERBOARD_PAGE_SIZE))
+    page = min(max(page, 1), pages)
+    offset = (page - 1) * LEADERBOARD_PAGE_SIZE
+    lines = []
+    for i, (uid, xp) in enumerate(xp_ranks.top(guild.id, offset, LEADERBOARD_PAGE_SIZE), start=offset + 1):
+        lines.append(f"**#{i}** <@{uid}> — Level {xp_to_level(xp)} ({xp} XP)")
+    embed = discord.Embed(title=f"🏆 Leaderboard — {guild.name}", description="\n".join(lines) or "No XP earned yet.", color=discord.Color.gold())
+    embed.set_footer(text=f"Page {page}/{pages} • {total} members ranked")
+    return embed, page, pages
+
+class LeaderboardView(View):
+    def __init__(self, guild: discord.Guild, page: int):
+        super().__init__(timeout=120)
+        self.guild = guild
+        self.page = page
+
+    async def show(self, interaction: discord.Interaction, page: int):
+        embed, self.page, _ = leaderboard_embed(self.guild, page)
+        await interaction.response.edit_message(embed=embed, view=self)
+
+    @discord.ui.button(label="◀ Prev", style=discord.ButtonStyle.gray)
+    async def prev_btn(self, interaction: discord.Interaction, button: Button):
+        await self.show(interaction, self.page - 1)
+
+    @discord.ui.button(label="Next ▶", style=discord.ButtonStyle.gray)
+    async def next_btn(self, interaction: discord.Interaction, button: Button):
+        await self.show(interaction, self.page + 1)
+
+@bot.tree.command(name="leaderboard", description="Show the server XP leaderboard")
+@app_commands.describe(page="Page number")
+async def leaderboard(interaction: discord.Interaction, page: int = 1):
+    embed, page, pages = leaderboard_embed(interaction.guild, page)
+    view = LeaderboardView(interaction.guild, page) if pages > 1 else None
+    if view:
+        await interaction.response.send_message(embed=embed, view=view)
+    else:
+        await interaction.response.send_message(embed=embed)
+
+@bot.tree.command(name="rank", description="Show your (or a member's) level and rank")
+async def rank(interaction: discord.Interaction, member: discord.Member = None):
+    member = member or interaction.user
+    entry = xp_store.get(interaction.guild.id, member.id)
+    if not entry:
+        await interaction.response.send_message(f"{member.mention} has no XP yet.", ephemeral=True)
+        return
+    xp = entry[0]
+    lvl = xp_to_level(xp)
+    pos = xp_ranks.rank(interaction.guild.id, member.id, xp)
+    embed = discord.Embed(title=f"📈 Rank for {member}", color=discord.Color.gold())
+    embed.set_thumbnail(url=member.display_avatar.url)
+    embed.add_field(name="Rank", value=f"#{pos} of {xp_ranks.size(interaction.guild.id)}", inline=True)
+    embed.add_field(name="Level", value=str(lvl), inline=True)
+    embed.add_field(name="XP", value=f"{xp} ({level_to_xp(lvl + 1) - xp} to next level)", inline=True)
+    await interaction.response.send_message(embed=embed)
+
 # ---------------------------
 # Help view (button-based)
 # ---------------------------
@@ -742,9 +3627,10 @@ class HelpView(View):
     @discord.ui.button(label="Moderation ⚔️", style=discord.ButtonStyle.blurple)
     async def mod_btn(self, interaction: discord.Interaction, button: Button):
         desc = (
-            "• `/kick`, `/ban`, `/unban`\n"
+            "• `/kick`, `/ban`, `/tempban`, `/unban`, `/unban_bulk`\n"
+            "• `/purge`, `/massban` — raid cleanup\n"
             "• `/warn`, `/warnings`, `/clearwarns`\n"
-            "• `/timeout`, `/untimeout`, `/timeouts`\n"
+            "• `/timeout`, `/untimeout`, `/timeouts`, `/temprole`\n"
             "• `/infractions` — full punishment summary\n"
             "• Auto-warn after 3 timeouts; Auto-ban after 5 warnings"
         )
@@ -755,6 +3641,7 @@ class HelpView(View):
         desc = (
             "• `/ticket_panel` — Create ticket creation button\n"
             "• `/ticket_category` — Set a category for tickets\n"
+            "• `/ticket_transcript` — Transcript format (txt, jsonl, html)\n"
             "• `/reaction_panel` — Create reaction/button role panel\n"
             "• `/add_reaction_role` — Link emoji -> role for a panel"
         )
@@ -764,7 +3651,8 @@ class HelpView(View):
     async def xp_btn(self, interaction: discord.Interaction, button: Button):
         desc = (
             "• Active XP system: chat messages grant XP and levels\n"
-            "• Admins can configure role rewards in config.json\n"
+            "• `/rank` — your level and rank, `/leaderboard` — top members\n"
+            "• Admins can configure role rewards in config.json (picked up within seconds)\n"
             "• `/premium true` to enable premium utilities"
         )
         await self.update_embed(interaction, "✨ XP & Premium", desc, discord.Color.blurple())
@@ -810,71 +3698,536 @@ async def cycle_status():
             print("Failed to change presence:", traceback.format_exc())
         await asyncio.sleep(60)  # rotate every 60 seconds
 
+# ---------------------------
+# Cluster stats (reported to launcher.py)
+# ---------------------------
+started_at = time.time()
+
+def collect_stats():
+    workers = event_router.stats()
+    return {
+        "cluster": CLUSTER_ID,
+        "pid": os.getpid(),
+        "shards": sorted(bot.shards) if AUTO_SHARD else [0],
+        "guilds": len(bot.guilds),
+        "latency": bot.latency if bot.is_ready() else None,
+        "uptime": time.time() - started_at,
+        "messages_processed": sum(w["processed"] for w in workers),
+        "messages_dropped": sum(w["dropped"] for w in workers),
+        "max_worker_lag": max((w["max_lag_seconds"] for w in workers), default=0.0),
+        "xp": xp_store.stats(),
+        "dm": dm_dispatcher.stats(),
+        "log": log_dispatcher.stats(),
+        "scheduler": scheduler.stats(),
+    }
+
+cluster_sock = None
+
+@tasks.loop(seconds=CLUSTER_REPORT_INTERVAL)
+async def cluster_reporter():
+    # one datagram per interval to the launcher's unix socket; never blocks
+    global cluster_sock
+    if cluster_sock is None:
+        cluster_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        cluster_sock.setblocking(False)
+    try:
+        cluster_sock.sendto(json.dumps(collect_stats()).encode("utf-8"), CLUSTER_IPC)
+    except OSError:
+        pass
+
+# ---------------------------
+# Metrics endpoint
+# ---------------------------
+loop_lag = {"last": 0.0, "max": 0.0}
+
+async def measure_loop_lag(interval=0.5):
+    # how late a plain sleep wakes up = how long callbacks are blocking the loop
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = time.perf_counter() - t0 - interval
+        loop_lag["last"] = lag
+        loop_lag["max"] = max(loop_lag["max"], lag)
+
+class _RateLimitCounter(logging.Handler):
+    # discord.py retries 429s itself and only logs them; count those log lines
+    def emit(self, record):
+        if "rate limit" in record.getMessage().lower():
+            metrics.inc("bot_rest_ratelimited_total")
+
+def instrument_http():
+    http = bot.http
+    request = http.request
+
+    async def counted_request(route, **kwargs):
+        metrics.inc("bot_rest_requests_total", method=route.method)
+        try:
+            return await request(route, **kwargs)
+        except discord.HTTPException as e:
+            if e.status == 429:
+                metrics.inc("bot_rest_ratelimit_failures_total", method=route.method)
+            raise
+
+    http.request = counted_request
+    logging.getLogger("discord.http").addHandler(_RateLimitCounter(logging.WARNING))
+
+def gauge_samples():
+    samples = [
+        ("bot_gateway_latency_seconds", {}, bot.latency if bot.is_ready() else float("nan")),
+        ("bot_event_loop_lag_seconds", {}, loop_lag["last"]),
+        ("bot_event_loop_lag_max_seconds", {}, loop_lag["max"]),
+        ("bot_guilds", {}, len(bot.guilds)),
+        ("bot_xp_pending_deltas", {}, xp_store.pending_deltas),
+        ("bot_log_queue_depth", {}, log_dispatcher.stats()["queued"]),
+        ("bot_log_dropped", {}, log_dispatcher.dropped),
+        ("bot_dm_queue_depth", {}, dm_dispatcher.stats()["queued"]),
+        ("bot_dm_deduped", {}, dm_dispatcher.deduped),
+        ("bot_dm_dropped", {}, dm_dispatcher.dropped),
+        ("bot_dm_welcome_queue_depth", {}, dm_dispatcher.stats()["welcome_queued"]),
+        ("bot_dm_welcome_dropped", {}, dm_dispatcher.welcome_dropped),
+    ]
+    for w in event_router.stats():
+        labels = {"worker": w["worker"]}
+        samples.append(("bot_event_queue_depth", labels, w["depth"]))
+        samples.append(("bot_event_queue_lag_seconds", labels, w["lag_seconds"]))
+        samples.append(("bot_event_queue_dropped", labels, w["dropped"]))
+        samples.append(("bot_event_queue_shed", labels, w["shed"]))
+    return samples
+
+async def metrics_handler(request):
+    return web.Response(text=metrics.render(gauge_samples()), content_type="text/plain", charset="utf-8")
+
+metrics_runner = None
+
+async def start_metrics_server():
+    global metrics_runner
+    if metrics_runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    metrics_runner = web.AppRunner(app, access_log=None)
+    await metrics_runner.setup()
+    # clusters started by launcher.py share one env, so each takes its own port
+    port = METRICS_PORT + int(CLUSTER_ID or 0)
+    await web.TCPSite(metrics_runner, METRICS_HOST, port).start()
+    spawn(measure_loop_lag())
+    print(f"📈 Metrics on http://{METRICS_HOST}:{port}/metrics")
+
+@bot.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    started = interaction.extras.get("started")
+    if started is not None:
+        took = time.perf_counter() - started
+        metrics.observe("bot_command_seconds", took, command=command.qualified_name)
+        if active_profile is not None:
+            active_profile.record_handler("/" + command.qualified_name, took)
+
+# ---------------------------
+# Live profiling (/debug profile)
+# ---------------------------
+# A sampler thread snapshots the event loop thread's stack every few ms and
+# counts collapsed stacks ("a;b;c" -> samples, the flamegraph.pl input
+# format). While it runs, asyncio debug mode is switched on so callbacks that
+# block the loop longer than PROFILE_SLOW_CALLBACK are logged and collected,
+# and timed handlers/commands report their wall time into a per-handler tally.
+PROFILE_INTERVAL = 0.005
+PROFILE_MAX_DEPTH = 64
+PROFILE_SLOW_CALLBACK = 0.05
+PROFILE_TOP = 10
+SLOW_CALLBACK_RE = re.compile(r"^Executing (.+) took ([0-9.]+) seconds$")
+
+class _SlowCallbackCollector(logging.Handler):
+    def __init__(self, profile):
+        super().__init__(logging.WARNING)
+        self.profile = profile
+
+    def emit(self, record):
+        m = SLOW_CALLBACK_RE.match(record.getMessage())
+        if m:
+            self.profile.slow_callbacks.append((float(m.group(2)), m.group(1)[:200]))
+
+class LoopProfile:
+    def __init__(self, loop, interval=PROFILE_INTERVAL):
+        self.loop = loop
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.idle = 0
+        self.slow_callbacks = []
+        self.handlers = {}  # name -> [calls, total seconds, max seconds]
+        self._stop = threading.Event()
+        self._thread = None
+        self._log_handler = _SlowCallbackCollector(self)
+        self._saved_debug = None
+
+    def record_handler(self, name, seconds):
+        h = self.handlers.get(name)
+        if h is None:
+            self.handlers[name] = [1, seconds, seconds]
+        else:
+            h[0] += 1
+            h[1] += seconds
+            if seconds > h[2]:
+                h[2] = seconds
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None and len(names) < PROFILE_MAX_DEPTH:
+                code = frame.f_code
+                names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            names.reverse()
+            self.samples += 1
+            # the loop is idle when it is parked in the selector
+            if names[-1].startswith(("selectors.py:select", "selector_events.py:select")):
+                self.idle += 1
+            self.stacks[";".join(names)] += 1
+
+    def start(self):
+        self._saved_debug = (self.loop.get_debug(), self.loop.slow_callback_duration)
+        self.loop.set_debug(True)
+        self.loop.slow_callback_duration = PROFILE_SLOW_CALLBACK
+        logging.getLogger("asyncio").addHandler(self._log_handler)
+        self._thread = threading.Thread(target=self._sample, name="loop-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        logging.getLogger("asyncio").removeHandler(self._log_handler)
+        debug, slow = self._saved_debug
+        self.loop.set_debug(debug)
+        self.loop.slow_callback_duration = slow
+
+    def collapsed(self):
+        return "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+    def summary(self, seconds, top=PROFILE_TOP):
+        busy = self.samples - self.idle
+        own, inclusive = collections.Counter(), collections.Counter()
+        for stack, n in self.stacks.items():
+            frames = stack.split(";")
+            if frames[-1].startswith(("selectors.py:select", "selector_events.py:select")):
+                continue
+            own[frames[-1]] += n
+            for name in set(frames):
+                inclusive[name] += n
+        pct = lambda n: f"{n * 100 / busy:5.1f}%" if busy else "  n/a"
+        lines = [f"{seconds}s, {self.samples} samples, loop busy in {busy} ({busy * 100 / max(1, self.samples):.1f}%)", ""]
+        lines.append(f"Top {top} by own time (% of busy samples):")
+        lines += [f"{pct(n)}  {name}" for name, n in own.most_common(top)]
+        lines.append("")
+        lines.append(f"Top {top} by inclusive time:")
+        # loop plumbing is in every stack; skip it so the list shows real work
+        plumbing = ("base_events.py:", "runners.py:", "events.py:_run", "client.py:run", "bot.py:<module>")
+        lines += [f"{pct(n)}  {name}" for name, n in inclusive.most_common(top + len(plumbing)) if not name.startswith(plumbing)][:top]
+        lines.append("")
+        slow = sorted(self.slow_callbacks, reverse=True)
+        lines.append(f"Slow callbacks (>{PROFILE_SLOW_CALLBACK * 1000:.0f}ms): {len(slow)}")
+        lines += [f"{took * 1000:7.1f}ms  {what[:90]}" for took, what in slow[:5]]
+        lines.append("")
+        lines.append("Slowest handlers (max / avg / calls):")
+        ranked = sorted(self.handlers.items(), key=lambda kv: kv[1][2], reverse=True)
+        lines += [f"{h[2] * 1000:7.1f}ms / {h[1] / h[0] * 1000:6.1f}ms / {h[0]:>6}  {name}" for name, h in ranked[:top]]
+        return "\n".join(lines)
+
+async def is_bot_owner(interaction: discord.Interaction):
+    return await bot.is_owner(interaction.user)
+
+debug_group = app_commands.Group(name="debug", description="Owner-only diagnostics",
+                                 default_permissions=discord.Permissions(administrator=True))
+
+@debug_group.command(name="profile", description="Sample the running event loop and report hot spots")
+@app_commands.check(is_bot_owner)
+@app_commands.describe(seconds="How long to sample (1-300)")
+async def debug_profile(interaction: discord.Interaction, seconds: app_commands.Range[int, 1, 300] = 10):
+    global active_profile
+    if active_profile is not None:
+        await interaction.response.send_message("❌ A profile is already running.", ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    profile = LoopProfile(asyncio.get_running_loop())
+    active_profile = profile
+    profile.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profile.stop()
+        active_profile = None
+    text = profile.summary(seconds)
+    name = f"profile-{int(time.time())}.folded"
+    data = io.BytesIO(profile.collapsed().encode("utf-8"))
+    await interaction.followup.send(
+        f"```\n{text[:1900]}\n```",
+        file=discord.File(data, filename=name),
+        ephemeral=True,
+    )
+
+bot.tree.add_command(debug_group)
+
 # ---------------------------
 # Startup helpers
 # ---------------------------
-async def rebuild_views_on_startup():
-    await bot.wait_until_ready()
-    # Reattach views for reaction-role button panels (best-effort)
-    for mid, panel in list(reaction_panels.items()):
+COMMAND_HASH_FILE = "command_tree.hash"
+startup_timings = {}  # phase -> seconds since BOOT_STARTED (marks) or duration
+
+def startup_mark():
+    return time.perf_counter() - BOOT_STARTED
+
+async def load_state():
+    # Storage and config first (the infractions migration needs the guild
+    # list), then the independent kinds side by side in the executor.
+    global storage, config, reaction_panels
+    t0 = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    storage = await loop.run_in_executor(None, make_storage)
+    config = await loop.run_in_executor(None, storage.load, "config")
+    reaction_panels, *_ = await asyncio.gather(
+        loop.run_in_executor(None, storage.load, "reaction_panels"),
+        loop.run_in_executor(None, load_xp),
+        loop.run_in_executor(None, infractions.load),
+        loop.run_in_executor(None, scheduler.load),
+    )
+    infractions.schedule_expiries()
+    os.makedirs(TICKETS_DIR, exist_ok=True)
+    startup_timings["state"] = time.perf_counter() - t0
+
+def command_tree_hash():
+    payload = [cmd.to_dict(bot.tree) for cmd in bot.tree.get_commands()]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+async def sync_command_tree():
+    # Push the global commands only when their definitions changed since the
+    # last sync by this application (or with --sync). In a shard cluster only
+    # cluster 0 syncs.
+    if CLUSTER_ID not in (None, "0"):
+        return
+    digest = f"{bot.application_id}:{command_tree_hash()}"
+    try:
+        with open(COMMAND_HASH_FILE, "r", encoding="utf-8") as f:
+            stored = f.read().strip()
+    except OSError:
+        stored = None
+    if stored == digest and "--sync" not in sys.argv:
+        return
+    t0 = time.perf_counter()
+    try:
+        synced = await bot.tree.sync()
+    except Exception:
+        print("command tree sync failed:", traceback.format_exc())
+        return
+    with open(COMMAND_HASH_FILE, "w", encoding="utf-8") as f:
+        f.write(digest)
+    startup_timings["sync"] = time.perf_counter() - t0
+    print(f"🔄 Synced {len(synced)} application commands")
+
+def start_background_tasks():
+    spawn(cycle_status())
+    xp_store.start()
+    scheduler.start()
+    spam_sweeper.start()
+    infraction_compactor.start()
+    if isinstance(storage, JSONStorage):
+        config_watcher.start()
+    if CLUSTER_IPC:
+        cluster_reporter.start()
+
+def log_startup_timings():
+    t = startup_timings
+    sync = f"tree sync {t['sync']:.2f}s" if "sync" in t else "tree unchanged"
+    print(f"⏱️ Startup: import {t['import']:.2f}s | login {t['login'] - t['import']:.2f}s "
+          f"(state load {t['state']:.2f}s alongside) | setup {t['setup'] - t['login']:.2f}s ({sync}) | "
+          f"gateway ready {t['ready'] - t['setup']:.2f}s | total {t['ready']:.2f}s")
+
+def register_reaction_views():
+    # Button panels keep their components on the message itself; registering
+    # a persistent view per panel is enough to handle them after a restart,
+    # so startup makes no REST calls. Reaction panels need nothing at all.
+    for mid, panel in reaction_panels.items():
+        if panel.get("type") == "button":
+            try:
+                bot.add_view(ReactionRoleView(mid), message_id=int(mid))
+            except Exception:
+                print("register_reaction_views error:", traceback.format_exc())
+
+# ---------------------------
+# Join flood handling
+# ---------------------------
+# A per-guild sliding join counter decides between one welcome message per
+# member and "burst mode", where joins are collected and welcomed with one
+# combined message per window. Past the raid threshold the raid hook fires.
+JOIN_WINDOW = 10           # seconds
+JOIN_BURST_THRESHOLD = 5   # joins per window that switch on burst mode
+JOIN_RAID_THRESHOLD = 20   # joins per window that trigger the raid hook
+RAID_COOLDOWN = 300        # seconds before the raid hook can fire again
+WELCOME_NAMES_SHOWN = 3
+
+class _JoinState:
+    __slots__ = ("times", "pending", "pending_count", "flushing", "raid_at")
+
+    def __init__(self, maxlen):
+        self.times = collections.deque(maxlen=maxlen)
+        self.pending = []
+        self.pending_count = 0
+        self.flushing = False
+        self.raid_at = 0.0
+
+class JoinAggregator:
+    def __init__(self):
+        self.guilds = {}
+
+    def record(self, guild_id, window, maxlen, now=None):
+        # returns the number of joins in the last `window` seconds (capped at maxlen)
+        now = time.monotonic() if now is None else now
+        st = self.guilds.get(guild_id)
+        if st is None or st.times.maxlen != maxlen:
+            st = self.guilds[guild_id] = _JoinState(maxlen)
+        st.times.append(now)
+        while st.times and now - st.times[0] > window:
+            st.times.popleft()
+        return len(st.times)
+
+    def bursting(self, guild_id):
+        st = self.guilds.get(guild_id)
+        return st is not None and st.flushing
+
+    def should_fire_raid(self, guild_id, now=None):
+        now = time.monotonic() if now is None else now
+        st = self.guilds[guild_id]
+        if now - st.raid_at < RAID_COOLDOWN:
+            return False
+        st.raid_at = now
+        return True
+
+    def defer_welcome(self, channel, member: discord.Member, window):
+        st = self.guilds[member.guild.id]
+        if len(st.pending) < WELCOME_NAMES_SHOWN:
+            st.pending.append(member.mention)
+        st.pending_count += 1
+        if not st.flushing:
+            st.flushing = True
+            spawn(self._flush(channel, member.guild, window))
+
+    async def _flush(self, channel, guild: discord.Guild, window):
+        st = self.guilds[guild.id]
         try:
-            gid = int(panel["guild"])
-            g = bot.get_guild(gid)
-            if not g: continue
-            for ch in g.text_channels:
-                try:
-                    m = await ch.fetch_message(int(mid))
-                    if panel.get("type") == "button":
-                        await m.edit(view=ReactionRoleView(mid))
+            # keep collecting while joins keep coming
+            while True:
+                await asyncio.sleep(window)
+                names, count = st.pending, st.pending_count
+                st.pending, st.pending_count = [], 0
+                if not count:
                     break
-                except:
-                    continue
-        except:
-            continue
+                others = count - len(names)
+                who = ", ".join(names)
+                if others:
+                    who += f" and {others} other{'s' if others != 1 else ''}"
+                try:
+                    await channel.send(f"🎉 Welcome {who} to **{guild.name}**!")
+                except Exception:
+                    pass
+        finally:
+            st.flushing = False
+
+join_aggregator = JoinAggregator()
+
+async def raid_detected(guild: discord.Guild, joins, window, lockdown):
+    # raid hook: always logged; with raid_lockdown enabled the server's
+    # verification level is raised to the highest setting
+    log_action(guild, f"🚨 Possible raid: {joins} joins in {window}s", LOG_HIGH)
+    if not lockdown:
+        return
+    try:
+        await guild.edit(verification_level=discord.VerificationLevel.highest, reason="Raid lockdown")
+        log_action(guild, "🔒 Raid lockdown: verification level set to highest. Lower it again once the raid is over.", LOG_HIGH)
+    except Exception:
+        log_action(guild, "⚠️ Raid lockdown failed (missing Manage Server permission?)", LOG_HIGH)
 
 # ---------------------------
 # Events: welcome/goodbye & ready
 # ---------------------------
 @bot.event
+@timed("bot_event_seconds", "on_member_join")
 async def on_member_join(member: discord.Member):
     gcfg = guild_config(member.guild.id)
-    if gcfg.get("welcome_channel"):
-        ch = member.guild.get_channel(int(gcfg["welcome_channel"]))
+    window = gcfg.join_window or JOIN_WINDOW
+    burst = gcfg.join_burst_threshold or JOIN_BURST_THRESHOLD
+    raid = gcfg.join_raid_threshold or JOIN_RAID_THRESHOLD
+    joins = join_aggregator.record(member.guild.id, window, max(burst, raid))
+    if joins >= raid and join_aggregator.should_fire_raid(member.guild.id):
+        spawn(raid_detected(member.guild, joins, window, gcfg.raid_lockdown))
+    if gcfg.welcome_channel:
+        ch = member.guild.get_channel(gcfg.welcome_channel)
         if ch:
-            await ch.send(f"🎉 Welcome {member.mention} to **{member.guild.name}**!")
-    try:
-        dm_template = gcfg.get("welcome_dm", "👋 Welcome {user} to {server}!")
-        message = dm_template.replace("{user}", member.name).replace("{server}", member.guild.name)
-        await member.send(message)
-    except:
-        pass
-    log_action(member.guild, f"✅ Member joined: {member}")
+            if joins >= burst or join_aggregator.bursting(member.guild.id):
+                join_aggregator.defer_welcome(ch, member, window)
+            else:
+                await ch.send(f"🎉 Welcome {member.mention} to **{member.guild.name}**!")
+    # during a join burst the channel gets one combined welcome and the
+    # joiners get no DM at all
+    if joins < burst and not join_aggregator.bursting(member.guild.id):
+        message = gcfg.welcome_dm.replace("{user}", member.name).replace("{server}", member.guild.name)
+        send_dm(member, message, welcome=True)
+    log_action(member.guild, f"✅ Member joined: {member}", LOG_LOW)
 
 @bot.event
+@timed("bot_event_seconds", "on_member_remove")
 async def on_member_remove(member: discord.Member):
     gcfg = guild_config(member.guild.id)
-    if gcfg.get("goodbye_channel"):
-        ch = member.guild.get_channel(int(gcfg["goodbye_channel"]))
+    if gcfg.goodbye_channel:
+        ch = member.guild.get_channel(gcfg.goodbye_channel)
         if ch:
             await ch.send(f"👋 {member.name} has left the server.")
-    log_action(member.guild, f"❌ Member left: {member}")
+    log_action(member.guild, f"❌ Member left: {member}", LOG_LOW)
 
 @bot.event
 async def on_ready():
+    # fires again after every reconnect; all startup work is in setup_hook
     print(f"✅ Logged in as {bot.user} (ID: {bot.user.id})")
-    try:
-        await bot.tree.sync()
-    except Exception:
-        pass
-    # start background tasks
-    bot.loop.create_task(cycle_status())
-    bot.loop.create_task(rebuild_views_on_startup())
-    load_xp()
-    print("Background tasks started.")
+    if "ready" not in startup_timings:
+        startup_timings["ready"] = startup_mark()
+        log_startup_timings()
 
 # ---------------------------
 # Run the bot
 # ---------------------------
+def _sigterm(*_):
+    # let bot.run() shut down cleanly (docker stop sends SIGTERM)
+    raise KeyboardInterrupt
+
 if __name__ == "__main__":
-    load_xp()
-    bot.run(TOKEN)
+    if "--import-json" in sys.argv:
+        # one-shot: copy the JSON state files into a new SQLite database and
+        # exit. An existing database holds newer state than the JSON files,
+        # so it is never overwritten.
+        if os.path.exists(DB_FILE):
+            print(f"{DB_FILE} already exists; not importing the JSON files over it")
+            sys.exit(1)
+        db = SQLiteStorage(DB_FILE)
+        import_json_into(db)
+        db.close()
+        sys.exit(0)
+    if "--import-xp" in sys.argv or "--export-xp" in sys.argv:
+        # one-shot: rebuild the XP store from xp.json, or dump it to xp.json
+        storage = make_storage()
+        if "--import-xp" in sys.argv:
+            xp_store.import_json(XP_FILE)
+        else:
+            xp_store.load()
+            xp_store.export_json(XP_FILE)
+        storage.close()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, _sigterm)
+    try:
+        bot.run(TOKEN)
+    finally:
+        if storage is not None:
+            save_xp()
+            infractions.flush_sync()
+            config_store.flush()
+            storage.close()
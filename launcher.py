@@ -0,0 +1,148 @@
+# launcher.py - run bot.py as K processes, each owning a contiguous range of shards
+# Usage: python launcher.py [--clusters K] [--shards N] [--dry-run]
+#   --shards defaults to Discord's recommended shard count, --clusters to the CPU count.
+# The clusters share state through the SQLite backend (each guild lives on exactly one
+# shard, so per-guild rows are only ever written by one process) and report health/stats
+# over a unix datagram socket, which the launcher aggregates and prints.
+from dotenv import load_dotenv
+import os, sys, json, time, socket, signal, argparse, subprocess, urllib.request
+
+STATS_SOCKET = os.getenv("CLUSTER_IPC", "cluster.sock")
+SUMMARY_INTERVAL = 30  # seconds between aggregated stats lines
+RESTART_BACKOFF = 10   # seconds before restarting a cluster that exited
+
+def recommended_shards(token):
+    req = urllib.request.Request(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {token}", "User-Agent": "server-manager launcher"},
+    )
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        return int(json.load(resp)["shards"])
+
+def shard_ranges(shards, clusters):
+    # split 0..shards-1 into `clusters` contiguous, near-equal ranges
+    clusters = max(1, min(clusters, shards))
+    base, extra = divmod(shards, clusters)
+    ranges, start = [], 0
+    for i in range(clusters):
+        size = base + (1 if i < extra else 0)
+        ranges.append(range(start, start + size))
+        start += size
+    return ranges
+
+class Cluster:
+    def __init__(self, cid, shards, shard_count):
+        self.cid = cid
+        self.shards = shards
+        self.shard_count = shard_count
+        self.proc = None
+        self.exited_at = None
+        self.last_stats = None
+        self.last_seen = None
+
+    def start(self):
+        env = dict(os.environ)
+        env.update({
+            "SHARD_COUNT": str(self.shard_count),
+            "SHARD_IDS": f"{self.shards.start}-{self.shards.stop - 1}",
+            "CLUSTER_ID": str(self.cid),
+            "CLUSTER_IPC": os.path.abspath(STATS_SOCKET),
+            "STORAGE_BACKEND": "sqlite",
+        })
+        self.proc = subprocess.Popen([sys.executable, "bot.py"], env=env)
+        self.exited_at = None
+        print(f"[launcher] cluster {self.cid} started (pid {self.proc.pid}, shards {self.shards.start}-{self.shards.stop - 1})")
+
+def print_summary(clusters):
+    now = time.time()
+    guilds = sum((c.last_stats or {}).get("guilds", 0) for c in clusters)
+    processed = sum((c.last_stats or {}).get("messages_processed", 0) for c in clusters)
+    dropped = sum((c.last_stats or {}).get("messages_dropped", 0) for c in clusters)
+    parts = []
+    for c in clusters:
+        st = c.last_stats or {}
+        lat = st.get("latency")
+        state = "down" if c.proc is None or c.proc.poll() is not None else "up"
+        seen = f"{now - c.last_seen:.0f}s ago" if c.last_seen else "never"
+        parts.append(f"#{c.cid} {state} lat={lat * 1000:.0f}ms seen={seen}" if lat is not None else f"#{c.cid} {state} seen={seen}")
+    print(f"[launcher] guilds={guilds} processed={processed} dropped={dropped} | " + " | ".join(parts))
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Run the bot as several shard clusters")
+    parser.add_argument("--clusters", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--shards", type=int, default=None)
+    parser.add_argument("--dry-run", action="store_true", help="print the shard plan and exit")
+    args = parser.parse_args()
+
+    token = os.getenv("TOKEN")
+    if not token:
+        raise RuntimeError("No TOKEN in .env. Add TOKEN=your_bot_token")
+    shards = args.shards or recommended_shards(token)
+    ranges = shard_ranges(shards, args.clusters)
+    clusters = [Cluster(i, r, shards) for i, r in enumerate(ranges)]
+    for c in clusters:
+        print(f"[launcher] cluster {c.cid}: shards {c.shards.start}-{c.shards.stop - 1} of {shards}")
+    if args.dry_run:
+        return
+
+    # seed the shared database from the JSON files the first time only, before
+    # several processes race to create it; once it exists it is the live state
+    if not os.path.exists(os.getenv("DB_FILE", "bot.db")):
+        db_env = dict(os.environ, STORAGE_BACKEND="sqlite")
+        subprocess.run([sys.executable, "bot.py", "--import-json"], env=db_env, check=True)
+
+    if os.path.exists(STATS_SOCKET):
+        os.unlink(STATS_SOCKET)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(STATS_SOCKET)
+    sock.settimeout(1.0)
+
+    stopping = False
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for c in clusters:
+        c.start()
+    next_summary = time.time() + SUMMARY_INTERVAL
+    try:
+        while not stopping:
+            try:
+                data = sock.recv(65536)
+                st = json.loads(data)
+                c = clusters[int(st["cluster"])]
+                c.last_stats, c.last_seen = st, time.time()
+            except socket.timeout:
+                pass
+            except (ValueError, KeyError, IndexError, TypeError):
+                pass
+            now = time.time()
+            for c in clusters:
+                if c.proc.poll() is None:
+                    continue
+                if c.exited_at is None:
+                    c.exited_at = now
+                    print(f"[launcher] cluster {c.cid} exited with code {c.proc.returncode}")
+                elif now - c.exited_at >= RESTART_BACKOFF:
+                    c.start()
+            if now >= next_summary:
+                print_summary(clusters)
+                next_summary = now + SUMMARY_INTERVAL
+    finally:
+        for c in clusters:
+            if c.proc and c.proc.poll() is None:
+                c.proc.send_signal(signal.SIGTERM)
+        for c in clusters:
+            if c.proc:
+                try:
+                    c.proc.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    c.proc.kill()
+        sock.close()
+        os.unlink(STATS_SOCKET)
+
+if __name__ == "__main__":
+    main()